@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+离线回放基准脚本
+启动本地替身服务 (Gemini / Notion / GitHub / SMTP)，离线运行完整的 researcher.py 流程并计时
+
+录制: 正常运行 researcher.py 时，LLM 原始响应会缓存到 .cache/llm_cache/*.json
+回放: 将缓存文件 (或任一期 docs/archives/*.md) 作为 --fixture，替身服务按固定延迟返回同样的内容
+
+用法:
+    python replay_harness.py --fixture docs/archives/2025-12-27.md --interaction-seconds 20 --subscribers 300
+"""
+
+import os
+import re
+import ast
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_fixture(path):
+    """
+    读取回放用的报告原文，支持三种来源：
+    - LLM 缓存文件 (.json)：直接取其中的 text
+    - 归档页面 (docs/archives/*.md)：由 Front Matter 与正文还原出带标记的原始报告
+    - 其他文本文件：原样使用
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+
+    if path.endswith(".json"):
+        return json.loads(text)["text"]
+
+    front_matter = re.match(r'^---\n(.*?)\n---\n', text, re.DOTALL)
+    if not front_matter:
+        return text
+
+    fields = dict(re.findall(r'^(\w+): (.*)$', front_matter.group(1), re.MULTILINE))
+    body = text[front_matter.end():]
+    body = body.split('<div class="subscribe-card">')[0]
+    body = re.sub(r'^.*?> \*\*摘要\*\*:.*?\n', '', body, count=1, flags=re.DOTALL)
+    body = re.sub(r'---(START|END)_CONTENT---', '', body).strip()
+
+    metadata = {
+        "title": fields.get("title", ""),
+        "summary": fields.get("description", ""),
+        "tags": ast.literal_eval(fields.get("tags", "[]")),
+        "importance": 8
+    }
+    return f"""---START_METADATA---
+{json.dumps(metadata, ensure_ascii=False, indent=2)}
+---END_METADATA---
+
+---START_CONTENT---
+{body}
+---END_CONTENT---
+"""
+
+
+class CallLog:
+    """记录替身服务收到的每一次调用，结束后写成 JSONL 供比对"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, service, method, path, status, latency, size):
+        with self.lock:
+            self.entries.append({
+                "t": round(time.time() - self.start, 3),
+                "service": service,
+                "method": method,
+                "path": path,
+                "status": status,
+                "latency": round(latency, 3),
+                "bytes": size,
+            })
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        stats = {}
+        for entry in self.entries:
+            count, latency = stats.get(entry["service"], (0, 0.0))
+            stats[entry["service"]] = (count + 1, latency + entry["latency"])
+        return stats
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """替身服务的公共部分：统一的延迟注入、JSON 读写和调用记录"""
+
+    protocol_version = "HTTP/1.1"
+    service = ""
+    latency = 0.0
+    call_log = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _send(self, status, payload, content_type="application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def _dispatch(self):
+        start = time.time()
+        time.sleep(self.latency)
+        path = self.path.split("?")[0]
+        status, payload = self.route(self.command, path, self._read_json())
+        content_type = "text/event-stream" if isinstance(payload, bytes) else "application/json"
+        size = self._send(status, payload, content_type)
+        self.call_log.add(self.service, self.command, path, status, time.time() - start, size)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _dispatch
+
+    def route(self, method, path, body):
+        return 404, {"message": f"{method} {path} 未被替身服务实现"}
+
+
+class GeminiStandIn(StandInHandler):
+    """Gemini generateContent / streamGenerateContent / interactions 的替身"""
+
+    service = "gemini"
+    report_text = ""
+    interaction_seconds = 0.0
+    interaction_status = "completed"
+    interactions = {}
+
+    def _usage(self, body):
+        prompt_chars = len(json.dumps(body.get("contents", ""), ensure_ascii=False))
+        return {
+            "promptTokenCount": prompt_chars // 4,
+            "candidatesTokenCount": len(self.report_text) // 4,
+            "totalTokenCount": (prompt_chars + len(self.report_text)) // 4,
+        }
+
+    def _candidate(self, text):
+        return {"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP", "index": 0}
+
+    def route(self, method, path, body):
+        if path.endswith(":generateContent"):
+            return 200, {"candidates": [self._candidate(self.report_text)], "usageMetadata": self._usage(body)}
+
+        if path.endswith(":streamGenerateContent"):
+            chunks = [self.report_text[i:i + 200] for i in range(0, len(self.report_text), 200)]
+            events = []
+            for i, chunk in enumerate(chunks):
+                event = {"candidates": [self._candidate(chunk)]}
+                if i == len(chunks) - 1:
+                    event["usageMetadata"] = self._usage(body)
+                events.append(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n")
+            return 200, "".join(events).encode("utf-8")
+
+        match = re.search(r'/interactions(?:/([^/]+))?$', path)
+        if match and method == "POST":
+            interaction_id = f"replay-{uuid.uuid4().hex[:12]}"
+            self.interactions[interaction_id] = time.time()
+            return 200, {"id": interaction_id, "status": "in_progress"}
+        if match and match.group(1):
+            created = self.interactions.get(match.group(1))
+            if created is None:
+                return 404, {"error": {"message": "interaction not found"}}
+            if time.time() - created < self.interaction_seconds:
+                return 200, {"id": match.group(1), "status": "in_progress"}
+            if self.interaction_status == "failed":
+                return 200, {"id": match.group(1), "status": "failed", "error": "replay: simulated failure"}
+            return 200, {"id": match.group(1), "status": "completed",
+                         "outputs": [{"type": "text", "text": self.report_text}]}
+
+        return super().route(method, path, body)
+
+
+class NotionStandIn(StandInHandler):
+    """Notion pages / databases / data_sources / blocks 的替身，订阅者数据库返回虚拟订阅者"""
+
+    service = "notion"
+    subscribers_id = "replay-subscribers"
+    subscribers = 0
+
+    def _subscriber_page(self, i):
+        return {
+            "object": "page",
+            "id": f"subscriber-{i}",
+            "last_edited_time": "2025-01-01T00:00:00.000Z",
+            "properties": {"Email": {"id": "mail", "type": "email", "email": f"reader{i}@example.com"}},
+        }
+
+    def route(self, method, path, body):
+        match = re.search(r'/(?:data_sources|databases)/([^/]+)/query$', path)
+        if match:
+            if match.group(1) != self.subscribers_id:
+                return 200, {"object": "list", "results": [], "has_more": False, "next_cursor": None}
+            offset = int(body.get("start_cursor") or 0)
+            end = min(offset + int(body.get("page_size") or 100), self.subscribers)
+            has_more = end < self.subscribers
+            return 200, {"object": "list", "results": [self._subscriber_page(i) for i in range(offset, end)],
+                         "has_more": has_more, "next_cursor": str(end) if has_more else None}
+
+        match = re.search(r'/databases/([^/]+)$', path)
+        if match and method == "GET":
+            return 200, {"object": "database", "id": match.group(1),
+                         "data_sources": [{"id": f"{match.group(1)}-source", "name": "replay"}]}
+
+        if path.endswith("/pages") and method == "POST":
+            return 200, {"object": "page", "id": str(uuid.uuid4()), "properties": body.get("properties", {})}
+        if re.search(r'/pages/[^/]+$', path):
+            return 200, {"object": "page", "id": path.rsplit("/", 1)[-1], "properties": body.get("properties", {})}
+        if re.search(r'/blocks/[^/]+$', path) and method == "DELETE":
+            return 200, {"object": "block", "id": path.rsplit("/", 1)[-1], "in_trash": True}
+        if re.search(r'/blocks/[^/]+(/children)?$', path):
+            results = [dict(block, id=str(uuid.uuid4())) for block in body.get("children", [])]
+            return 200, {"object": "list", "results": results, "has_more": False, "next_cursor": None}
+
+        return super().route(method, path, body)
+
+
+class GitHubStandIn(StandInHandler):
+    """GitHub REST API 中 get_repo / create_issue 的替身"""
+
+    service = "github"
+    base_url = ""
+    issue_number = 0
+
+    def route(self, method, path, body):
+        match = re.match(r'^/repos/([^/]+)/([^/]+)(/issues)?$', path)
+        if not match:
+            return super().route(method, path, body)
+
+        full_name = f"{match.group(1)}/{match.group(2)}"
+        repo_url = f"{self.base_url}/repos/{full_name}"
+        if not match.group(3):
+            return 200, {"id": 1, "name": match.group(2), "full_name": full_name, "url": repo_url,
+                         "owner": {"login": match.group(1), "id": 1}}
+
+        type(self).issue_number += 1
+        return 201, {"id": self.issue_number, "number": self.issue_number, "title": body.get("title"),
+                     "url": f"{repo_url}/issues/{self.issue_number}",
+                     "html_url": f"https://github.com/{full_name}/issues/{self.issue_number}",
+                     "labels": [{"name": name} for name in body.get("labels", [])]}
+
+
+def start_http_stand_in(handler_class, **attrs):
+    """在后台线程启动一个替身 HTTP 服务，返回 (server, base_url)"""
+    handler = type(handler_class.__name__, (handler_class,), attrs)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    handler.base_url = base_url
+    return server, base_url
+
+
+def start_smtp_sink(call_log, latency):
+    """启动 aiosmtpd 收件黑洞，接受任意账号登录；未安装 aiosmtpd 时返回 (None, None)"""
+    try:
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.smtp import AuthResult
+    except ImportError:
+        print("⚠️ 未安装 aiosmtpd (pip install aiosmtpd)，跳过 SMTP 替身，邮件推送将被禁用")
+        return None, None
+
+    class SinkHandler:
+        async def handle_DATA(self, server, session, envelope):
+            start = time.time()
+            await asyncio.sleep(latency)
+            call_log.add("smtp", "DATA", ",".join(envelope.rcpt_tos), 250,
+                         time.time() - start, len(envelope.content or b""))
+            return "250 Message accepted for delivery"
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    controller = Controller(SinkHandler(), hostname="127.0.0.1", port=port,
+                            authenticator=lambda *args: AuthResult(success=True),
+                            auth_require_tls=False)
+    controller.start()
+    return controller, port
+
+
+def run_replay(args):
+    print("=" * 70)
+    print("🎬 AI Daily News Brief - 离线回放")
+    print("=" * 70)
+
+    report_text = load_fixture(args.fixture)
+    print(f"📼 回放素材: {args.fixture} ({len(report_text)} 字符)")
+
+    call_log = CallLog()
+    servers = []
+    gemini, gemini_url = start_http_stand_in(
+        GeminiStandIn, latency=args.gemini_latency, call_log=call_log, report_text=report_text,
+        interaction_seconds=args.interaction_seconds, interaction_status=args.interaction_status,
+        interactions={})
+    notion, notion_url = start_http_stand_in(
+        NotionStandIn, latency=args.notion_latency, call_log=call_log, subscribers=args.subscribers)
+    github, github_url = start_http_stand_in(GitHubStandIn, latency=args.github_latency, call_log=call_log)
+    servers.extend([gemini, notion, github])
+    smtp, smtp_port = start_smtp_sink(call_log, args.smtp_latency)
+
+    # 在临时目录里运行，避免覆盖仓库中的 docs/
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    shutil.copytree(os.path.join(ROOT_DIR, "docs"), os.path.join(workdir, "docs"))
+
+    env = dict(os.environ)
+    env.pop("TEST_RECIPIENT", None)
+    env.update({
+        "GEMINI_API_KEY": "replay-key",
+        "GEMINI_BASE_URL": gemini_url,
+        "NOTION_TOKEN": "replay-token",
+        "NOTION_BASE_URL": notion_url,
+        "NOTION_DATABASE_ID": "replay-database",
+        "NOTION_SUBSCRIBERS_DB_ID": NotionStandIn.subscribers_id,
+        "GITHUB_TOKEN": "replay-token",
+        "GITHUB_REPOSITORY": "replay/AI-Daily-News-Brief",
+        "GITHUB_API_URL": github_url,
+        "STATE_DIR": os.path.join(workdir, ".cache"),
+        "LLM_CACHE": "0",
+    })
+    if smtp:
+        env.update({
+            "EMAIL_HOST": "127.0.0.1",
+            "EMAIL_PORT": str(smtp_port),
+            "EMAIL_USER": "brief@example.com",
+            "EMAIL_PASSWORD": "replay",
+            "EMAIL_USE_TLS": "0",
+            # 回放测量的是流水线本身，关闭发送限速与额度
+            "EMAIL_RATE_PER_MINUTE": "0",
+            "EMAIL_DAILY_QUOTA": "0",
+            "EMAIL_DOMAIN_RATE_PER_MINUTE": "0",
+            "EMAIL_SPREAD_MINUTES": "0",
+        })
+    else:
+        env.pop("EMAIL_USER", None)
+    # 离线回放不能经真实的发件账号登录和发送
+    env.pop("EMAIL_ACCOUNTS", None)
+
+    print(f"📂 工作目录: {workdir}")
+    print("🚀 开始运行 researcher.py ...\n")
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT_DIR, "researcher.py")],
+        cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL if args.quiet else None,
+    )
+    elapsed = time.time() - start
+
+    for server in servers:
+        server.shutdown()
+    if smtp:
+        smtp.stop()
+
+    log_path = os.path.join(workdir, "replay_log.jsonl")
+    call_log.dump(log_path)
+
+    print("\n" + "=" * 70)
+    print("📊 回放结果")
+    print("=" * 70)
+    print(f"  退出码:     {result.returncode}")
+    print(f"  总耗时:     {elapsed:.2f} 秒")
+    for service, (count, latency) in sorted(call_log.summary().items()):
+        print(f"  {service:10s}  调用 {count:5d} 次 | 累计服务端耗时 {latency:7.2f} 秒")
+    print(f"  调用记录:   {log_path}")
+    print("=" * 70)
+    return result.returncode
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线回放完整的 researcher.py 流程")
+    parser.add_argument("--fixture", default=os.path.join(ROOT_DIR, "docs", "archives", "2025-12-27.md"),
+                        help="回放素材: LLM 缓存 JSON、归档 Markdown 或原始报告文本")
+    parser.add_argument("--interaction-seconds", type=float, default=15,
+                        help="Deep Research 替身任务从创建到完成的秒数")
+    parser.add_argument("--interaction-status", choices=["completed", "failed"], default="completed",
+                        help="Deep Research 替身任务的最终状态 (failed 用于演练降级路径)")
+    parser.add_argument("--subscribers", type=int, default=50, help="Notion 替身中的虚拟订阅者数量")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="Gemini 每次调用的固定延迟 (秒)")
+    parser.add_argument("--notion-latency", type=float, default=0.3, help="Notion 每次调用的固定延迟 (秒)")
+    parser.add_argument("--github-latency", type=float, default=0.2, help="GitHub 每次调用的固定延迟 (秒)")
+    parser.add_argument("--smtp-latency", type=float, default=0.05, help="SMTP 每封邮件的固定延迟 (秒)")
+    parser.add_argument("--quiet", action="store_true", help="不输出 researcher.py 的运行日志")
+    sys.exit(run_replay(parser.parse_args()))
@@ -2,15 +2,31 @@ import os
 import json
 import re
 import time
+import hashlib
+import tempfile
+import atexit
+import functools
+import random
+import statistics
+import threading
+import bisect
+import sqlite3
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.utils import formatdate
+import email.policy
 import markdown
 from google import genai
 from google.genai import types
 from notion_client import Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+import httpx
 from github import Github
 
 # 设置北京时区
@@ -33,72 +49,981 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 NOTION_SUBSCRIBERS_DB_ID = os.getenv("NOTION_SUBSCRIBERS_DB_ID")
 TEST_RECIPIENT = os.getenv("TEST_RECIPIENT")
 
-client = genai.Client(api_key=GEMINI_API_KEY)
-notion = Client(auth=NOTION_TOKEN)
+# 研究调度配置
+# 对冲模式: Deep Research 任务启动 N 秒后并行启动降级方案，取先完成且格式合格的报告
+# 设为 0 表示两者同时启动；留空则保持"失败后才降级"的串行行为
+HEDGE_FALLBACK_DELAY = os.getenv("HEDGE_FALLBACK_DELAY")
+
+DEEP_RESEARCH_AGENT = 'deep-research-pro-preview-12-2025'
+
+# Deep Research 轮询配置 (单位: 秒)
+DEEP_RESEARCH_TIMEOUT = 3600        # 最长等待时间
+POLL_WARMUP_SECONDS = 180           # 任务启动后的密集轮询期（快速失败多发生在此阶段）
+POLL_FAST_INTERVAL = 10             # 密集轮询间隔
+POLL_MAX_INTERVAL = 120             # 中段指数退避的上限
+POLL_TAIL_INTERVAL = 30             # 超过历史 p90 后的轮询间隔 (即原先的固定间隔)
+DEFAULT_MEDIAN_COMPLETION = 600     # 没有历史记录时假定的中位完成时间
+
+# Deep Research 熔断器: 连续失败达到阈值后直接走降级方案，冷却期过后下一次运行作为半开探测
+BREAKER_THRESHOLD = int(os.getenv("DEEP_RESEARCH_BREAKER_THRESHOLD", 2))
+BREAKER_COOLDOWN_HOURS = float(os.getenv("DEEP_RESEARCH_BREAKER_COOLDOWN_HOURS", 48))
+
+# 降级方案模式: single = 单次 generate_content 覆盖全部领域; sharded = 按覆盖领域并行分片研究
+FALLBACK_MODE = os.getenv("FALLBACK_MODE", "single")
+SHARD_TIMEOUT = int(os.getenv("SHARD_TIMEOUT", 300))  # 单个分片的最长等待时间 (秒)
+# 流式降级方案: 边生成边解析，METADATA 和每条情报一到达即可使用，格式出错时立即中止
+FALLBACK_STREAM = os.getenv("FALLBACK_STREAM") == "1"
+STREAM_MARKER_DEADLINE = 20000  # 等待下一个标记的最多字符数 (思考过程可能较长)
+# 结构化输出: 降级方案与 AI 重新格式化按 JSON Schema 输出，Markdown 在本地渲染 (优先于流式模式)
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT") == "1"
+
+# 分片研究的覆盖领域 (顺序即合并后的优先级)
+RESEARCH_SHARDS = [
+    {"name": "🔥 重大发布", "tag": "大模型",
+     "focus": "OpenAI, Google (DeepMind), Anthropic, Meta, NVIDIA, Microsoft 的官方博客、产品发布与模型更新"},
+    {"name": "🧪 学术与技术", "tag": "前沿研究",
+     "focus": "ArXiv 上有重大影响的论文，以及 HuggingFace 上的热门模型与论文"},
+    {"name": "🛠️ 开源与工具", "tag": "开源",
+     "focus": "GitHub Trending (AI/ML 类别) 上的项目，以及新的开发者工具、库与框架"},
+    {"name": "📉 商业与风向", "tag": "行业动态",
+     "focus": "融资、并购、合作、人才流动，以及市场与行业趋势分析"},
+    {"name": "💬 社区热议", "tag": "社区",
+     "focus": "Reddit (r/LocalLlama, r/MachineLearning) 与 Hacker News 上的热门讨论与争议"},
+]
+
+# 已报道情报过滤: 从 docs/archives 提取近 N 天的来源 URL 与标题指纹，注入 prompt 并在生成后去重 (0 = 关闭)
+COVERAGE_LOOKBACK_DAYS = int(os.getenv("COVERAGE_LOOKBACK_DAYS", 7))
+COVERAGE_MAX_PROMPT_ITEMS = 40      # 注入 prompt 的排除条目上限，避免 prompt 过长
+HEADLINE_SIMILARITY = 0.8           # 标题指纹的 bigram 相似度阈值 (数字不同的标题始终视为不同情报)
+
+# Notion 访问: 所有请求共用一个令牌桶 (Notion 平均限速约 3 次/秒)，429 按 Retry-After 加抖动退避重试
+# 页面创建时最多携带 100 个 block，其余按批顺序追加
+NOTION_BATCH_SIZE = 100
+NOTION_RETRIES = int(os.getenv("NOTION_RETRIES", 3))
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", 3))  # 每秒请求数
+NOTION_BURST = 3                    # 令牌桶容量 (允许的短时突发)
+# 非幂等接口：超时 / 5xx / 连接中断后请求可能已生效，自动重试会产生重复的页面或 block
+NOTION_NON_IDEMPOTENT = ("pages.create", "blocks.children.append")
+NOTION_PAGE_CACHE_DAYS = 30         # 本地保留 发布日期 → 页面/block 映射的天数 (用于同日重跑时原地更新)
+
+# 跨运行的本地状态目录 (GitHub Actions 中通过 actions/cache 持久化)
+STATE_DIR = os.getenv("STATE_DIR", ".cache")
+
+# 订阅者本地缓存 (SQLite): 每次只向 Notion 查询上次同步后修改过的订阅者，定期全量同步以清理已删除的行
+SUBSCRIBERS_DB_PATH = os.path.join(STATE_DIR, "subscribers.sqlite3")
+SUBSCRIBER_FULL_SYNC_DAYS = int(os.getenv("SUBSCRIBER_FULL_SYNC_DAYS", 7))
+SUBSCRIBER_SYNC_OVERLAP = 300       # 增量同步的时间窗口重叠 (秒)，容忍时钟偏差与分钟级的 last_edited_time
+EMAIL_QUEUE_SIZE = 500              # 订阅者读取与邮件发送之间的有界队列长度
+EMAIL_CONNECTIONS = int(os.getenv("EMAIL_CONNECTIONS", 4))  # 并行发送的 SMTP 连接数
+SMTP_TIMEOUT = 60                   # 单个 SMTP 操作的超时 (秒)
+# 投递日志: 记录当天已成功发送的收件人，中断后重跑只补发剩余部分
+DELIVERY_JOURNAL_PATH = os.path.join(STATE_DIR, "delivery_journal.sqlite3")
+DELIVERY_JOURNAL_DAYS = 7           # 投递记录保留天数
+# 发送调度: 发件账号与收件域名各自限速，超出当日额度的收件人延期到下次运行优先发送
+SMTP_PROVIDER_LIMITS = {            # 常见服务商的默认限额 (每分钟, 每天)，保守取值避免账号被暂停发送
+    "smtp.gmail.com": (60, 500),    # 免费账号上限；Workspace 账号可设 EMAIL_DAILY_QUOTA=2000
+    "smtp.office365.com": (30, 10000),
+    "smtp-mail.outlook.com": (30, 300),
+    "smtp.qq.com": (20, 500),
+    "smtp.163.com": (20, 400),
+}
+EMAIL_RATE_PER_MINUTE = int(os.getenv("EMAIL_RATE_PER_MINUTE", SMTP_PROVIDER_LIMITS.get(EMAIL_HOST, (0, 0))[0]))  # 0 表示不限速
+EMAIL_DAILY_QUOTA = int(os.getenv("EMAIL_DAILY_QUOTA", SMTP_PROVIDER_LIMITS.get(EMAIL_HOST, (0, 0))[1]))          # 0 表示不限额
+EMAIL_DOMAIN_RATE_PER_MINUTE = int(os.getenv("EMAIL_DOMAIN_RATE_PER_MINUTE", 0))      # 小型收件域名的限速，避免突发被灰名单 (0 表示不限速)
+EMAIL_SPREAD_MINUTES = int(os.getenv("EMAIL_SPREAD_MINUTES", 0))  # 把当天的发送均匀分散到 N 分钟内 (0 表示尽快发完)
+MAJOR_MAILBOX_DOMAINS = {           # 大型邮箱服务商能承受突发，不按域名限速
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com", "yahoo.com", "icloud.com",
+    "qq.com", "foxmail.com", "163.com", "126.com",
+}
+EMAIL_DEFERRED_STATE = "email_deferred.json"
+# 多发件账号 (可选): JSON 列表，每项 {"user", "password", "host", "port", "use_tls", "rate_per_minute", "daily_quota"}
+# 省略的字段沿用 EMAIL_* 配置；未设置时只使用 EMAIL_USER 一个账号。收件人按一致性哈希固定分配到账号
+EMAIL_ACCOUNTS = os.getenv("EMAIL_ACCOUNTS", "")
+SENDER_RING_VNODES = 64             # 一致性哈希环上每个账号的虚拟节点数
+
+# LLM 响应缓存: 按 模型/Agent + prompt 哈希 + 日期 寻址，重跑时直接复用 (LLM_CACHE=0 关闭)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE_DIR = os.path.join(STATE_DIR, "llm_cache")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 3 * 24 * 3600))  # 缓存保留时长 (秒)
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", 1))  # generate_content 失败后的重试次数
+
+# 模型调用统计: 每次调用的 token、耗时、重试与估算成本，运行结束时写入 JSON 报告
+RUN_REPORT_PATH = os.getenv("RUN_REPORT_PATH", os.path.join(STATE_DIR, "run_report.json"))
+# 估算用的单价 (美元 / 百万 tokens: 输入, 输出含思考)，未列出的模型按 0 计
+MODEL_PRICING = {
+    "gemini-3-pro-preview": (2.00, 12.00),
+    "gemini-2.0-flash-exp": (0.00, 0.00),
+}
+
+# 服务地址覆盖 (留空使用官方地址；replay_harness.py 借此指向本地替身服务)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+NOTION_BASE_URL = os.getenv("NOTION_BASE_URL")
+GITHUB_API_URL = os.getenv("GITHUB_API_URL")
+EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "1") != "0"
+
+class NotionEndpoint:
+    """RateLimitedNotion 的属性代理: notion.blocks.children.append(...) 最终交给 RateLimitedNotion.request"""
+
+    def __init__(self, owner, target, path):
+        self._owner = owner
+        self._target = target
+        self._path = path
+
+    def __getattr__(self, name):
+        return NotionEndpoint(self._owner, getattr(self._target, name), f"{self._path}.{name}")
+
+    def __call__(self, *args, **kwargs):
+        return self._owner.request(self._path, self._target, *args, **kwargs)
+
+class RateLimitedNotion:
+    """
+    notion_client.Client 的共享包装 (线程安全)，调用方式与原 Client 相同
+    - 令牌桶限速：所有线程、所有接口共用 NOTION_RATE_LIMIT 次/秒
+    - 429 按 Retry-After 暂停整个桶，409 / 5xx / 超时 / 网络错误按指数退避 + 抖动重试，其余 4xx 与程序错误直接抛出
+    - 创建页面、追加 block 等非幂等接口只重试确定未被处理的请求 (409 / 429 / 连接失败)
+    - 按接口统计调用次数、重试、错误与耗时，stats() 写入运行报告
+    """
+
+    def __init__(self, client, rate=NOTION_RATE_LIMIT, burst=NOTION_BURST, retries=NOTION_RETRIES):
+        self._client = client
+        self._rate = rate
+        self._burst = burst
+        self._retries = retries
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __getattr__(self, name):
+        return NotionEndpoint(self, getattr(self._client, name), name)
+
+    def _acquire(self):
+        """预订一个令牌 (令牌可以为负，表示排队中的请求)，在锁外等待到预订时刻"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = max(-self._tokens / self._rate, self._paused_until - now)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pause(self, seconds):
+        """收到 429 时暂停所有线程的请求，并清空令牌避免恢复后立即突发"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0)
+
+    def _record(self, path, elapsed, retries=0, error=None):
+        with self._lock:
+            entry = self._stats.setdefault(path, {"calls": 0, "retries": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+            entry["calls"] += 1
+            entry["retries"] += retries
+            entry["errors"] += 1 if error else 0
+            entry["seconds"] += elapsed
+            entry["max_seconds"] = max(entry["max_seconds"], elapsed)
+
+    def request(self, path, method, *args, **kwargs):
+        for attempt in range(self._retries + 1):
+            self._acquire()
+            start_time = time.time()
+            try:
+                result = method(*args, **kwargs)
+                self._record(path, time.time() - start_time, retries=1 if attempt else 0)
+                return result
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as e:
+                self._record(path, time.time() - start_time, retries=1 if attempt else 0, error=e)
+                status = getattr(e, "status", None)
+                if path in NOTION_NON_IDEMPOTENT:
+                    retryable = status in (409, 429) or isinstance(e, httpx.ConnectError)
+                else:
+                    retryable = status is None or status in (409, 429) or status >= 500
+                if not retryable or attempt == self._retries:
+                    raise
+                delay = (2 ** attempt) * random.uniform(0.5, 1.5)
+                if status == 429:
+                    headers = getattr(e, "headers", None) or {}
+                    try:
+                        delay = max(delay, float(headers.get("retry-after", 0)))
+                    except (TypeError, ValueError):
+                        pass
+                    self._pause(delay)
+                print(f"⚠️ [Notion] {path} 失败 ({status or type(e).__name__})，{delay:.1f} 秒后重试: {e}")
+                if status != 429:
+                    time.sleep(delay)
+            except Exception as e:
+                self._record(path, time.time() - start_time, retries=1 if attempt else 0, error=e)
+                raise
+
+    def stats(self):
+        """各接口的调用统计 (平均 / 最大耗时，单位秒)"""
+        with self._lock:
+            return {path: dict(entry, seconds=round(entry["seconds"], 3), max_seconds=round(entry["max_seconds"], 3),
+                               avg_seconds=round(entry["seconds"] / entry["calls"], 3))
+                    for path, entry in self._stats.items()}
+
+if GEMINI_BASE_URL:
+    client = genai.Client(api_key=GEMINI_API_KEY, http_options=types.HttpOptions(base_url=GEMINI_BASE_URL))
+else:
+    client = genai.Client(api_key=GEMINI_API_KEY)
+if NOTION_BASE_URL:
+    notion = RateLimitedNotion(Client(auth=NOTION_TOKEN, base_url=NOTION_BASE_URL))
+else:
+    notion = RateLimitedNotion(Client(auth=NOTION_TOKEN))
+
+def open_subscriber_store():
+    """打开订阅者缓存库 (不存在时建表)"""
+    os.makedirs(os.path.dirname(SUBSCRIBERS_DB_PATH) or ".", exist_ok=True)
+    db = sqlite3.connect(SUBSCRIBERS_DB_PATH)
+    db.execute("CREATE TABLE IF NOT EXISTS subscribers (page_id TEXT PRIMARY KEY, email TEXT, last_edited TEXT, synced_at TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS sync_meta (key TEXT PRIMARY KEY, value TEXT)")
+    return db
+
+def schema_signature(props):
+    """订阅者数据库的结构签名 (列名 + 类型)，签名不变时复用已识别的邮箱列"""
+    return hashlib.sha256(json.dumps(sorted((key, val.get("type")) for key, val in props.items()),
+                                     ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+def resolve_email_property(props):
+    """寻找常见的邮箱列名 (Email, 邮箱, Mail)"""
+    for key in props:
+        if "mail" in key.lower() or "邮箱" in key:
+            return key
+    return None
+
+def extract_email(props, column):
+    """根据 Notion 字段类型提取邮箱文本"""
+    val = props.get(column) if column else None
+    email = ""
+    if not val:
+        return email
+    if val["type"] == "email":
+        email = val["email"] or ""
+    elif val["type"] == "rich_text" and val["rich_text"]:
+        email = val["rich_text"][0]["text"]["content"]
+    elif val["type"] == "title" and val["title"]:
+        email = val["title"][0]["text"]["content"]
+    email = email.strip()
+    return email if "@" in email else ""
+
+def list_subscriber_ids():
+    """生成器：列出订阅者数据库中现存行的 page_id (只取标题列，不含已删除/归档的行)"""
+    query_kwargs = {"data_source_id": NOTION_SUBSCRIBERS_DB_ID, "page_size": 100, "filter_properties": ["title"]}
+    while True:
+        resp = notion.data_sources.query(**query_kwargs)
+        for page in resp.get("results", []):
+            if not (page.get("archived") or page.get("in_trash")):
+                yield page["id"]
+        if not resp.get("has_more"):
+            return
+        query_kwargs["start_cursor"] = resp.get("next_cursor")
+
+def sync_subscribers(db, full=False):
+    """
+    生成器：将 Notion 订阅者逐页同步到本地缓存，同时产出每一页中的邮箱
+    增量模式只查询 last_edited_time 不早于上次同步时间的行；数据源或结构变化、或距上次全量同步超过
+    SUBSCRIBER_FULL_SYNC_DAYS 天时改为全量同步；两种模式都会删除 Notion 中已不存在的行
+    (增量模式额外分页列出现存行的 ID 进行核对)
+    全部页面读取完毕后才提交，中途失败不会留下半同步的状态
+    """
+    meta = dict(db.execute("SELECT key, value FROM sync_meta"))
+    if meta.get("data_source_id") != NOTION_SUBSCRIBERS_DB_ID or not meta.get("cursor"):
+        full = True
+    last_full = meta.get("last_full_sync")
+    if not last_full or datetime.fromisoformat(last_full) < datetime.now(TZ_CN) - timedelta(days=SUBSCRIBER_FULL_SYNC_DAYS):
+        full = True
+
+    sync_started = datetime.now(ZoneInfo("UTC"))
+    synced_at = sync_started.isoformat(timespec="microseconds")
+    signature, column = meta.get("schema_signature"), meta.get("email_property")
+    query_kwargs = {"data_source_id": NOTION_SUBSCRIBERS_DB_ID, "page_size": 100}
+    if not full:
+        query_kwargs["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": meta["cursor"]}}
+
+    updated = 0
+    start_cursor = None
+    while True:
+        if start_cursor:
+            query_kwargs["start_cursor"] = start_cursor
+        resp = notion.data_sources.query(**query_kwargs)
+        results = resp.get("results", [])
+        # 同一数据源内所有行的列结构相同，每页只需计算一次签名
+        page_signature = schema_signature(results[0].get("properties", {})) if results else signature
+        if page_signature != signature:
+            if not full and signature is not None:
+                # 表结构变了，已缓存的邮箱可能来自旧的列，改为全量同步
+                print("👥 订阅者数据库结构已变化，改为全量同步")
+                db.rollback()
+                yield from sync_subscribers(db, full=True)
+                return
+            signature, column = page_signature, resolve_email_property(results[0].get("properties", {}))
+        rows = []
+        for page in results:
+            archived = page.get("archived") or page.get("in_trash")
+            rows.append((page["id"], "" if archived else extract_email(page.get("properties", {}), column),
+                         page.get("last_edited_time"), synced_at))
+        db.executemany("INSERT OR REPLACE INTO subscribers VALUES (?, ?, ?, ?)", rows)
+        updated += len(rows)
+        for row in rows:
+            if row[1]:
+                yield row[1]
+        if not resp.get("has_more"):
+            break
+        start_cursor = resp.get("next_cursor")
+
+    removed = 0
+    if not full:
+        # 增量查询不会返回已删除/归档的行，用一次只取 ID 的查询核对仍存在的行
+        live_ids = set(list_subscriber_ids())
+        stale = [(page_id,) for (page_id,) in db.execute("SELECT page_id FROM subscribers") if page_id not in live_ids]
+        db.executemany("DELETE FROM subscribers WHERE page_id = ?", stale)
+        removed = len(stale)
+
+    cursor = (sync_started - timedelta(seconds=SUBSCRIBER_SYNC_OVERLAP)).strftime('%Y-%m-%dT%H:%M:00.000Z')
+    with db:
+        if full:
+            db.execute("DELETE FROM subscribers WHERE synced_at != ?", (synced_at,))
+        new_meta = {"data_source_id": NOTION_SUBSCRIBERS_DB_ID, "cursor": cursor,
+                    "schema_signature": signature, "email_property": column}
+        if full:
+            new_meta["last_full_sync"] = datetime.now(TZ_CN).isoformat(timespec="seconds")
+        db.executemany("INSERT OR REPLACE INTO sync_meta VALUES (?, ?)",
+                       [(key, value) for key, value in new_meta.items() if value is not None])
+    print(f"👥 订阅者{'全量' if full else '增量'}同步完成: 更新 {updated} 行" + (f"，移除 {removed} 行" if removed else ""))
+
+def iter_subscribers():
+    """
+    生成器：边同步边产出去重后的订阅者邮箱 (忽略大小写)
+    先产出本次从 Notion 同步到的行 (全量同步时即全部订阅者)，再补上本地缓存中未变化的订阅者；
+    Notion 不可用时直接退回上次缓存的名单
+    """
+    db = open_subscriber_store()
+    seen = set()
+    try:
+        try:
+            for email_addr in sync_subscribers(db):
+                if email_addr.lower() not in seen:
+                    seen.add(email_addr.lower())
+                    yield email_addr
+        except Exception as e:
+            db.rollback()
+            print(f"❌ 同步 Notion 订阅列表失败，使用本地缓存: {e}")
+        for (email_addr,) in db.execute("SELECT email FROM subscribers WHERE email != ''"):
+            if email_addr.lower() not in seen:
+                seen.add(email_addr.lower())
+                yield email_addr
+    finally:
+        db.close()
+
+class DeliveryJournal:
+    """
+    只追加的投递日志 (SQLite, WAL 模式)：每封邮件发送后立即记录 (日期, 收件人) 的哈希
+    WAL + synchronous=NORMAL 下每条记录提交即可在进程崩溃后保留，fsync 在检查点时批量进行
+    """
+
+    def __init__(self, date_str, path=DELIVERY_JOURNAL_PATH):
+        self.date_str = date_str
+        self.skipped = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS deliveries (key TEXT PRIMARY KEY, date TEXT, status TEXT, "
+                         "attempts INTEGER, error TEXT, updated_at TEXT, account TEXT)")
+        if "account" not in {row[1] for row in self._db.execute("PRAGMA table_info(deliveries)")}:
+            self._db.execute("ALTER TABLE deliveries ADD COLUMN account TEXT")
+        earliest = (datetime.now(TZ_CN) - timedelta(days=DELIVERY_JOURNAL_DAYS)).strftime('%Y-%m-%d')
+        with self._db:
+            self._db.execute("DELETE FROM deliveries WHERE date < ?", (earliest,))
+        # 已发送的 key → 发件账号 (用于按账号统计当日额度)
+        self._delivered = dict(self._db.execute(
+            "SELECT key, account FROM deliveries WHERE date = ? AND status = 'sent'", (date_str,)))
+
+    def _key(self, email_addr):
+        return hashlib.sha256(f"{self.date_str}:{email_addr.lower()}".encode("utf-8")).hexdigest()[:32]
+
+    def delivered(self, email_addr):
+        """今天是否已成功发送过 (是则计入 skipped)"""
+        if self._key(email_addr) in self._delivered:
+            with self._lock:
+                self.skipped += 1
+            return True
+        return False
+
+    def sent_count(self, account=None):
+        """今天已成功发送的封数 (计入当日额度)；account 为空时统计所有账号"""
+        with self._lock:
+            if account is None:
+                return len(self._delivered)
+            return sum(1 for sender in self._delivered.values() if sender == account)
+
+    def record(self, email_addr, error=None, account=None):
+        """记录一次发送结果 (及发件账号)；失败的记录在下次运行时重试"""
+        key = self._key(email_addr)
+        status = "failed" if error else "sent"
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO deliveries (key, date, status, attempts, error, updated_at, account) "
+                "VALUES (?, ?, ?, 1, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET status = excluded.status, "
+                "attempts = attempts + 1, error = excluded.error, updated_at = excluded.updated_at, account = excluded.account",
+                (key, self.date_str, status, str(error) if error else None,
+                 datetime.now(TZ_CN).isoformat(timespec="seconds"), account))
+            if not error:
+                self._delivered[key] = account
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def open_delivery_journal(date_str):
+    """打开投递日志；文件损坏或被锁时改名保留并重建，仍失败则本次不做去重记录 (返回 None)"""
+    try:
+        return DeliveryJournal(date_str)
+    except sqlite3.DatabaseError as e:
+        print(f"⚠️ 投递日志不可用: {e}")
+    broken = f"{DELIVERY_JOURNAL_PATH}.broken-{int(time.time())}"
+    try:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(DELIVERY_JOURNAL_PATH + suffix):
+                os.replace(DELIVERY_JOURNAL_PATH + suffix, broken + suffix)
+        journal = DeliveryJournal(date_str)
+        print(f"🧹 已将原投递日志移至 {broken}，重新开始记录")
+        return journal
+    except (OSError, sqlite3.DatabaseError) as e:
+        print(f"⚠️ 无法重建投递日志，本次发送不做去重记录: {e}")
+        return None
+
+class TokenBucket:
+    """令牌桶 (调用方负责加锁)：per_minute 为 0 表示不限速"""
+
+    def __init__(self, per_minute, burst=1):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """距离下一个令牌可用还需等待的秒数"""
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+class SendScheduler:
+    """
+    单个发件账号的发送调度器 (线程安全)：生产者放入收件人，该账号的发送线程取出下一位可以发送的收件人
+    - 每个收件域名一个队列，轮流取用，同一域名的邮件不会集中突发
+    - 发件账号一个令牌桶 (服务商限速 / 分散发送窗口)，小型收件域名各一个令牌桶
+    - quota 为当天剩余额度，用尽后不再发出也不再接收
+    - priority 中的收件人 (上次运行延期的) 排在所属域名队列的最前面
+    """
 
-def send_email_newsletter(metadata, markdown_content):
-    """通过 SMTP 发送 HTML 格式的简报邮件"""
-    if not EMAIL_USER or not EMAIL_PASSWORD:
+    def __init__(self, per_minute, quota=None, priority=(), maxsize=EMAIL_QUEUE_SIZE, burst=1):
+        self.quota = quota
+        self._account = TokenBucket(per_minute, burst)
+        self._domains = {}          # 域名 → 令牌桶 (大型邮箱服务商为 None)
+        self._queues = {}           # 域名 → 待发送的收件人 (dict 顺序即轮转顺序)
+        self._pending = 0
+        self._maxsize = maxsize
+        self._priority = {email_addr.lower() for email_addr in priority}
+        self._closed = False
+        self._retired = False
+        self._cond = threading.Condition()
+
+    def exhausted(self):
+        return self.quota is not None and self.quota <= 0
+
+    def idle(self):
+        return not self._pending
+
+    def finished(self):
+        """生产者已读完且队列已发完"""
+        return self._closed and not self._pending
+
+    def _enqueue(self, email_addr, front=False):
+        domain = email_addr.rpartition("@")[2].lower()
+        if domain not in self._domains:
+            self._domains[domain] = (None if domain in MAJOR_MAILBOX_DOMAINS or not EMAIL_DOMAIN_RATE_PER_MINUTE
+                                     else TokenBucket(EMAIL_DOMAIN_RATE_PER_MINUTE))
+        pending = self._queues.setdefault(domain, deque())
+        if front:
+            pending.appendleft(email_addr)
+        else:
+            pending.append(email_addr)
+        self._pending += 1
+        self._cond.notify_all()
+
+    def put(self, email_addr, block=True):
+        """放入一位收件人，队列满时等待 (block=False 时不等待，用于转交)；账号已停用或额度用尽时返回 False"""
+        with self._cond:
+            while block and self._pending >= self._maxsize and not self._retired and not self.exhausted():
+                self._cond.wait(1)
+            if self._retired or self.exhausted():
+                return False
+            self._enqueue(email_addr, front=email_addr.lower() in self._priority)
+            return True
+
+    def get(self):
+        """取出下一位可以发送的收件人 (必要时等待令牌)；全部发完、额度用尽或账号停用时返回 None"""
+        with self._cond:
+            while True:
+                if self._retired or self.exhausted():
+                    return None
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                account_wait = self._account.wait_time(now)
+                chosen, wait_s = None, None
+                for domain, pending in self._queues.items():
+                    bucket = self._domains[domain]
+                    domain_wait = max(account_wait, bucket.wait_time(now) if bucket else 0.0)
+                    if wait_s is None or domain_wait < wait_s:
+                        chosen, wait_s = domain, domain_wait
+                    if domain_wait <= 0:
+                        break
+                if wait_s > 0:
+                    self._cond.wait(wait_s)
+                    continue
+                # 取出后该域名移到轮转顺序末尾，队列空了则移除
+                pending = self._queues.pop(chosen)
+                email_addr = pending.popleft()
+                if pending:
+                    self._queues[chosen] = pending
+                self._account.take()
+                if self._domains[chosen]:
+                    self._domains[chosen].take()
+                self._pending -= 1
+                if self.quota is not None:
+                    self.quota -= 1
+                self._cond.notify_all()
+                return email_addr
+
+    def requeue(self, email_addr):
+        """连接失效时把已取出的收件人放回队首 (不受队列长度限制)，并退还额度；账号已停用时返回 False"""
+        with self._cond:
+            if self._retired:
+                return False
+            if self.quota is not None:
+                self.quota += 1
+            self._enqueue(email_addr, front=True)
+            return True
+
+    def close(self):
+        """不会再有新的收件人，发送线程发完队列后退出"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def unsent(self):
+        """仍在队列中、尚未发出的收件人"""
+        with self._cond:
+            return [email_addr for pending in self._queues.values() for email_addr in pending]
+
+    def retire(self):
+        """停用本账号：清空并返回队列中的收件人 (交给其他账号)，唤醒所有等待中的线程"""
+        with self._cond:
+            self._retired = True
+            unsent = [email_addr for pending in self._queues.values() for email_addr in pending]
+            self._queues.clear()
+            self._pending = 0
+            self._cond.notify_all()
+            return unsent
+
+class SenderAccount:
+    """一个发件账号：SMTP 配置与限额，以及本次运行的发送调度器"""
+
+    def __init__(self, config):
+        self.user = config["user"]
+        self.password = config["password"]
+        self.host = config.get("host", EMAIL_HOST)
+        self.port = int(config.get("port", EMAIL_PORT))
+        self.use_tls = bool(config.get("use_tls", EMAIL_USE_TLS))
+        # 与 EMAIL_HOST 相同的服务商沿用 EMAIL_RATE_PER_MINUTE / EMAIL_DAILY_QUOTA，其余按服务商的默认限额
+        rate, quota = ((EMAIL_RATE_PER_MINUTE, EMAIL_DAILY_QUOTA) if self.host == EMAIL_HOST
+                       else SMTP_PROVIDER_LIMITS.get(self.host, (0, 0)))
+        self.rate_per_minute = float(config.get("rate_per_minute", rate))
+        self.daily_quota = int(config.get("daily_quota", quota))
+        self.scheduler = None
+        self.workers = 0            # 仍在运行的发送线程数
+        self.failure = None         # 停用原因
+
+    def available(self):
+        return self.failure is None and not self.scheduler.exhausted()
+
+def load_sender_accounts():
+    """读取发件账号列表：EMAIL_ACCOUNTS (JSON)，未设置时为 EMAIL_USER / EMAIL_PASSWORD"""
+    try:
+        configs = json.loads(EMAIL_ACCOUNTS) if EMAIL_ACCOUNTS else []
+    except ValueError as e:
+        print(f"⚠️ EMAIL_ACCOUNTS 不是合法的 JSON，忽略: {e}")
+        configs = []
+    if isinstance(configs, dict):
+        configs = [configs]  # 只配置了一个账号
+    if not isinstance(configs, list) or not all(isinstance(config, dict) for config in configs):
+        print("⚠️ EMAIL_ACCOUNTS 应为账号对象的列表，忽略")
+        configs = []
+    if not configs and EMAIL_USER and EMAIL_PASSWORD:
+        configs = [{"user": EMAIL_USER, "password": EMAIL_PASSWORD}]
+    return [SenderAccount(config) for config in configs if config.get("user") and config.get("password")]
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big")
+
+class SenderRing:
+    """
+    发件账号的一致性哈希环 (线程安全)，每个账号在环上有 SENDER_RING_VNODES 个虚拟节点
+    - 收件人顺时针落到第一个可用的账号：同一收件人固定由同一账号发送，增减账号时只有约 1/N 的收件人换账号
+    - 账号登录失败、被限流、额度用尽或连接全部断开时停用，其队列中的收件人顺延给环上的下一个账号
+    - 所有账号都不可用时收件人记入 deferred，下次运行优先发送
+    """
+
+    def __init__(self, accounts):
+        nodes = sorted((ring_hash(f"{account.user}#{i}"), index)
+                       for index, account in enumerate(accounts) for i in range(SENDER_RING_VNODES))
+        self._keys = [key for key, _ in nodes]
+        self._owners = [accounts[index] for _, index in nodes]
+        self.accounts = accounts
+        self.deferred = []
+        self._producer_done = False
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def route(self, email_addr, skip=()):
+        """收件人在环上对应的第一个可用账号，没有可用账号时返回 None"""
+        start = bisect.bisect(self._keys, ring_hash(email_addr.lower()))
+        for offset in range(len(self._owners)):
+            account = self._owners[(start + offset) % len(self._owners)]
+            if account not in skip and account.available():
+                return account
+        return None
+
+    def put(self, email_addr, block=True):
+        """
+        把收件人交给负责的账号 (该账号队列满时等待)；没有可用账号时记入延期名单
+        发送已被 stop() 终止时返回 False，生产者据此停止读取
+        """
+        skip = set()
+        while not self._stopped:
+            account = self.route(email_addr, skip)
+            if account is None:
+                self._defer(email_addr)
+                return True
+            if account.scheduler.put(email_addr, block):
+                return True
+            skip.add(account)  # 等待期间该账号被停用或额度用尽
+        return False
+
+    def _defer(self, email_addr):
+        with self._lock:
+            self.deferred.append(email_addr)
+
+    def requeue(self, account, email_addr):
+        """连接失效时交还收件人：放回原账号，原账号已停用时转给其他账号"""
+        if not account.scheduler.requeue(email_addr) and not self.put(email_addr, block=False):
+            self._defer(email_addr)
+
+    def retire(self, account, reason, quiet=False):
+        """停用账号，其队列中的收件人按哈希环转给其他账号"""
+        with self._lock:
+            if account.failure:
+                return
+            account.failure = reason
+        unsent = account.scheduler.retire()
+        if not quiet:
+            moved = f"，{len(unsent)} 位收件人转给其他账号" if unsent else ""
+            print(f"⚠️ 发件账号 {account.user} 停用 ({reason}){moved}")
+        for email_addr in unsent:
+            if not self.put(email_addr, block=False):
+                self._defer(email_addr)
+        self.close_if_done()
+
+    def worker_exited(self, account, reason=None):
+        """
+        发送线程退出：账号级错误或该账号最后一条连接退出时停用该账号 (无论队列是否为空)，
+        之后生产者不会再向它放入收件人而阻塞；正常发完退出时静默停用
+        """
+        with self._lock:
+            account.workers -= 1
+            last = account.workers == 0
+        if reason or last:
+            finished = not reason and account.scheduler.finished()
+            self.retire(account, reason or "所有连接均不可用", quiet=finished)
+        else:
+            self.close_if_done()
+
+    def stop(self):
+        """所有发送线程退出后终止发送：生产者停止读取，仍在等待的放入立即返回"""
+        self._stopped = True
+        for account in self.accounts:
+            self.retire(account, "发送已终止", quiet=True)
+
+    def close(self):
+        """生产者读完所有收件人"""
+        with self._lock:
+            self._producer_done = True
+        self.close_if_done()
+
+    def close_if_done(self):
+        """
+        生产者已读完、且每个账号都已发完或停用时，关闭所有调度器让发送线程退出
+        提前发完的账号保持等待，以便接收其他账号停用时转交的收件人
+        """
+        with self._lock:
+            if not self._producer_done or not all(account.failure or account.scheduler.idle() for account in self.accounts):
+                return
+        for account in self.accounts:
+            account.scheduler.close()
+
+    def unsent(self):
+        """尚未发出的收件人：延期名单 + 仍在各账号队列中的"""
+        with self._lock:
+            deferred = list(self.deferred)
+        return deferred + [email_addr for account in self.accounts for email_addr in account.scheduler.unsent()]
+
+def produce_recipients(source, ring, journal=None):
+    """生产者线程：逐个读取收件人按哈希环交给各账号 (跳过今天已发送过的)，读完后通知哈希环"""
+    count = 0
+    try:
+        for email_addr in source:
+            count += 1
+            if journal and journal.delivered(email_addr):
+                continue
+            if not ring.put(email_addr):
+                return
+        skipped = f"，其中 {journal.skipped} 位今天已发送过" if journal and journal.skipped else ""
+        print(f"👥 共获取到 {count} 位订阅者{skipped}")
+    except Exception as e:
+        print(f"❌ 读取订阅列表失败: {e}")
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+        ring.close()
+
+class SmtpConnection:
+    """发件账号连接池中的一条 SMTP 连接：首次使用时连接并登录 (STARTTLS)，断线后重连重发一次，统计本连接的吞吐"""
+
+    def __init__(self, account, index):
+        self.account = account
+        self.index = index
+        self.server = None
+        self.sent = 0
+        self.failed = 0
+        self.reconnects = 0
+        self.busy_seconds = 0.0
+
+    def connect(self):
+        """
+        连接并登录；握手、STARTTLS 或登录失败时关闭半开的连接
+        除认证失败与限流外的 SMTP 错误统一作为连接错误抛出 (收件人交还调度器)，不计入单个收件人的失败
+        """
+        server = None
+        try:
+            server = smtplib.SMTP(self.account.host, self.account.port, timeout=SMTP_TIMEOUT)
+            if self.account.use_tls:
+                server.starttls()
+            server.login(self.account.user, self.account.password)
+        except Exception as e:
+            if server is not None:
+                server.close()
+            if (isinstance(e, smtplib.SMTPException) and not isinstance(e, smtplib.SMTPAuthenticationError)
+                    and not smtp_rate_limited(e)):
+                raise ConnectionError(f"SMTP 握手失败: {e}") from e
+            raise
+        self.server = server
+
+    def send(self, email_addr, data):
+        start_time = time.time()
+        try:
+            if self.server is None:
+                self.connect()
+            try:
+                self.server.sendmail(self.account.user, [email_addr], data)
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e:
+                print(f"⚠️ SMTP 连接 {self.account.user} #{self.index} 断开，重新连接: {e}")
+                self.reconnects += 1
+                self.close()
+                self.connect()
+                self.server.sendmail(self.account.user, [email_addr], data)
+            self.sent += 1
+        finally:
+            self.busy_seconds += time.time() - start_time
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def stats(self):
+        return {"account": self.account.user, "connection": self.index, "sent": self.sent, "failed": self.failed, "reconnects": self.reconnects,
+                "busy_seconds": round(self.busy_seconds, 2),
+                "per_second": round(self.sent / self.busy_seconds, 2) if self.busy_seconds else 0.0}
+
+def smtp_rate_limited(e):
+    """发件账号被服务商限流或超出额度：MAIL FROM / DATA 阶段返回 421 / 454，或错误信息中带 quota / rate 字样"""
+    if not isinstance(e, smtplib.SMTPResponseException):
+        return False
+    message = e.smtp_error.decode("utf-8", "replace") if isinstance(e.smtp_error, bytes) else str(e.smtp_error)
+    return e.smtp_code in (421, 454) or any(word in message.lower() for word in ("quota", "rate limit", "too many"))
+
+def record_delivery(journal, email_addr, account, error=None):
+    """写入投递日志；日志出错只告警，不影响发送流程"""
+    if not journal:
+        return
+    try:
+        journal.record(email_addr, error=error, account=account.user)
+    except Exception as e:
+        print(f"⚠️ 写入投递日志失败 ({email_addr}): {e}")
+
+def smtp_worker(connection, ring, build_message, journal=None):
+    """
+    发送线程：从所属账号的调度器取收件人，经自己的连接发送
+    - 单个收件人被拒只记为失败
+    - 重连后仍无法发送时本线程退出，当前收件人交还调度器，同账号的其他连接继续
+    - 登录失败、被服务商限流或当日额度用尽时停用整个账号，剩余收件人转给其他账号
+    """
+    account = connection.account
+    reason = None
+    try:
+        while True:
+            email_addr = account.scheduler.get()
+            if email_addr is None:
+                if account.scheduler.exhausted():
+                    reason = "今日额度已用尽"
+                return
+            try:
+                connection.send(email_addr, build_message(account.user, email_addr))
+            except (smtplib.SMTPAuthenticationError, smtplib.SMTPServerDisconnected) as e:
+                # 本连接不可用，收件人交还调度器由其他连接发送
+                ring.requeue(account, email_addr)
+                if isinstance(e, smtplib.SMTPAuthenticationError):
+                    reason = f"登录失败: {e}"
+                raise
+            except smtplib.SMTPException as e:
+                if smtp_rate_limited(e):
+                    ring.requeue(account, email_addr)
+                    reason = f"被服务商限流: {e}"
+                    raise
+                connection.failed += 1
+                print(f"⚠️ 发送至 {email_addr} 失败: {e}")
+                record_delivery(journal, email_addr, account, error=e)
+            except Exception:
+                # 连接层错误 (DNS 解析、SSL、网络不可达、超时等)：同样交还收件人，不能随线程退出而丢失
+                ring.requeue(account, email_addr)
+                raise
+            else:
+                # 已发出的邮件不再交还调度器：日志写入失败只告警，避免重复发送
+                print(f"✅ 邮件已发送至: {email_addr}")
+                record_delivery(journal, email_addr, account)
+            if account.scheduler.idle():
+                ring.close_if_done()
+    except Exception as e:
+        print(f"❌ SMTP 连接 {account.user} #{connection.index} 退出: {e}")
+    finally:
+        connection.close()
+        ring.worker_exited(account, reason)
+
+def unsubscribe_token(email_addr):
+    """收件人的退订标识，写入 List-Unsubscribe，退订邮件据此对应到订阅者"""
+    return hashlib.sha256(f"{EMAIL_USER}:{email_addr.lower()}".encode("utf-8")).hexdigest()[:16]
+
+def plan_send_schedule(accounts, journal):
+    """
+    按各账号的限额创建今天的发送调度器
+    - 每个账号的当日剩余额度 = daily_quota - 该账号今天已发送的封数
+    - 设置了 EMAIL_SPREAD_MINUTES 时，按缓存的订阅者数估算各账号的发送量 (哈希环上大致均分)，把速率降到刚好在窗口内发完
+    - 上次运行延期的收件人优先发送
+    """
+    expected = 0
+    if EMAIL_SPREAD_MINUTES:
+        db = open_subscriber_store()
+        try:
+            cached = db.execute("SELECT COUNT(*) FROM subscribers WHERE email != ''").fetchone()[0]
+        finally:
+            db.close()
+        expected = (cached - (journal.sent_count() if journal else 0)) / len(accounts)
+    deferred = load_state(EMAIL_DEFERRED_STATE, {}).get("recipients", [])
+    if deferred:
+        print(f"🚦 优先发送上次延期的 {len(deferred)} 位收件人")
+    for account in accounts:
+        sent_today = journal.sent_count(account.user) if journal else 0
+        quota = max(account.daily_quota - sent_today, 0) if account.daily_quota else None
+        per_minute = account.rate_per_minute
+        share = min(expected, quota) if quota is not None else expected
+        if share > 0:
+            spread_rate = share / EMAIL_SPREAD_MINUTES
+            per_minute = min(per_minute, spread_rate) if per_minute else spread_rate
+        print(f"🚦 发送调度 {account.user}: {f'{per_minute:.1f} 封/分钟' if per_minute else '不限速'} | "
+              f"{f'今日剩余额度 {quota}' if quota is not None else '不限额'}")
+        account.scheduler = SendScheduler(per_minute, quota, priority=deferred, burst=max(EMAIL_CONNECTIONS, 1))
+
+def save_deferred(date_str, unsent):
+    """保存未发出的收件人，下次运行优先发送 (没有延期时清空)"""
+    if unsent:
+        print(f"⏳ 发件账号额度已用尽或不可用，{len(unsent)} 位收件人延期到下次运行")
+    try:
+        save_state(EMAIL_DEFERRED_STATE, {"date": date_str, "recipients": unsent})
+    except OSError as e:
+        print(f"⚠️ 保存延期名单失败: {e}")
+
+def render_newsletter(report, full_html):
+    """
+    整封邮件只渲染、编码一次 (multipart/alternative: 纯文本 + HTML)
+    返回 build_message(sender, email_addr)：只拼接每个发件账号 / 收件人不同的几行头部，正文 bytes 直接复用
+    退订地址统一为 EMAIL_USER (未设置时为发件账号)，换发件账号不影响退订
+    """
+    date_str = datetime.now(TZ_CN).strftime('%Y-%m-%d')
+    msg = MIMEMultipart('alternative', policy=email.policy.SMTP)
+    msg['Subject'] = f"🤖 {report.metadata.get('title')} ({date_str})"
+    msg['Date'] = formatdate(localtime=True)
+    msg.attach(MIMEText(report.content, 'plain', 'utf-8', policy=email.policy.SMTP))
+    msg.attach(MIMEText(full_html, 'html', 'utf-8', policy=email.policy.SMTP))
+    shared_headers, body = msg.as_bytes().split(b"\r\n\r\n", 1)
+    body = b"\r\n\r\n" + body
+
+    def build_message(sender, email_addr):
+        headers = (f"\r\nFrom: AI Daily Brief <{sender}>"
+                   f"\r\nTo: {email_addr}"
+                   f"\r\nMessage-ID: <{uuid.uuid4().hex}@{sender.rpartition('@')[2] or 'localhost'}>"
+                   f"\r\nList-Unsubscribe: <mailto:{EMAIL_USER or sender}?subject=unsubscribe%20{unsubscribe_token(email_addr)}>")
+        return shared_headers + headers.encode("utf-8") + body
+
+    return build_message
+
+def send_email_newsletter(report):
+    """
+    通过 SMTP 发送 HTML 格式的简报邮件
+    订阅者读取与发送流水线执行：生产者线程边同步边把收件人按哈希环分给各发件账号，各账号的发送线程按限速边取边发
+    """
+    accounts = load_sender_accounts()
+    if not accounts:
         return
 
     print("📧 正在启动 SMTP 邮件推送...")
     
-    recipients = []
     if TEST_RECIPIENT:
         print(f"🧪 测试模式: 仅发送给 {TEST_RECIPIENT}")
-        recipients.append(TEST_RECIPIENT)
+        source = [TEST_RECIPIENT]
     elif NOTION_SUBSCRIBERS_DB_ID and notion:
         print("👥 正在从 Notion 读取订阅者列表...")
-        try:
-            # 查询 Notion 数据库 (分页获取所有用户)
-            has_more = True
-            start_cursor = None
-            
-            while has_more:
-                # 使用 Notion API 2025 (Data Sources)
-                query_kwargs = {
-                    "data_source_id": NOTION_SUBSCRIBERS_DB_ID,
-                    "page_size": 100
-                }
-                if start_cursor:
-                    query_kwargs["start_cursor"] = start_cursor
-                
-                resp = notion.data_sources.query(**query_kwargs)
-                
-                for page in resp.get("results", []):
-                    props = page.get("properties", {})
-                    email = ""
-                    # 尝试寻找常见的邮箱列名 (Email, 邮箱, Mail)
-                    for key, val in props.items():
-                        if "mail" in key.lower() or "邮箱" in key:
-                            # 根据 Notion 字段类型提取文本
-                            if val["type"] == "email":
-                                email = val["email"]
-                            elif val["type"] == "rich_text" and val["rich_text"]:
-                                email = val["rich_text"][0]["text"]["content"]
-                            elif val["type"] == "title" and val["title"]:
-                                email = val["title"][0]["text"]["content"]
-                            break
-                    
-                    if email and "@" in email:
-                        recipients.append(email.strip())
-                
-                has_more = resp.get("has_more")
-                start_cursor = resp.get("next_cursor")
-                
-            # 去重
-            recipients = list(set(recipients))
-            print(f"👥 共获取到 {len(recipients)} 位订阅者")
-            
-        except Exception as e:
-            print(f"❌ 读取 Notion 订阅列表失败: {e}")
-    
-    if not recipients:
-        print("⚠️ 没有收件人 (请配置 TEST_RECIPIENT 或 检查 Notion 连接)，跳过发送")
-        return
+        source = iter_subscribers()
+    else:
+        source = []
 
-    # 将 Markdown 转换为 HTML
-    html_body = markdown.markdown(markdown_content)
+    # 将 Markdown 转换为 HTML (Report 内缓存，只转换一次)
+    html_body = report.html
     
     full_html = f"""
     <html>
@@ -124,28 +1049,368 @@ def send_email_newsletter(metadata, markdown_content):
     </html>
     """
 
+    build_message = render_newsletter(report, full_html)
     try:
-        server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
-        server.starttls()
-        server.login(EMAIL_USER, EMAIL_PASSWORD)
-        
-        for email_addr in recipients:
-            msg = MIMEMultipart()
-            msg['From'] = f"AI Daily Brief <{EMAIL_USER}>"
-            msg['To'] = email_addr
-            date_str = datetime.now(TZ_CN).strftime('%Y-%m-%d')
-            msg['Subject'] = f"🤖 {metadata.get('title')} ({date_str})"
-            msg.attach(MIMEText(full_html, 'html'))
-            server.send_message(msg)
-            print(f"✅ 邮件已发送至: {email_addr}")
-            
-        server.quit()
+        deliver_newsletter(accounts, source, build_message)
     except Exception as e:
         print(f"❌ 邮件发送失败: {e}")
 
-def run_deep_research():
+def deliver_newsletter(accounts, source, build_message):
+    """读取收件人并经各发件账号的连接池发送，结束后保存延期名单并输出统计"""
+    # 测试模式只用第一个账号、不写投递日志、不限速，便于反复发送
+    date_str = datetime.now(TZ_CN).strftime('%Y-%m-%d')
+    if TEST_RECIPIENT:
+        accounts = accounts[:1]
+        accounts[0].scheduler = SendScheduler(0)
+        journal = None
+    else:
+        journal = open_delivery_journal(date_str)
+        plan_send_schedule(accounts, journal)
+    ring = SenderRing(accounts)
+    producer = threading.Thread(target=produce_recipients, args=(source, ring, journal), daemon=True)
+    producer.start()
+
+    # 每个账号一个连接池，每个发送线程持有一条连接，拿到第一个收件人时才连接登录
+    pool_size = 1 if TEST_RECIPIENT else max(EMAIL_CONNECTIONS, 1)
+    connections = []
+    for account in accounts:
+        account.workers = pool_size
+        connections.extend(SmtpConnection(account, i + 1) for i in range(pool_size))
+    workers = [threading.Thread(target=smtp_worker, args=(connection, ring, build_message, journal))
+               for connection in connections]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # 发送线程全部退出时每个账号都已停用。全部因额度用尽时让生产者读完，把剩余收件人都记入延期名单
+    # (下次优先发送，避免名单末尾的订阅者每天都轮不到)；否则终止生产者
+    if not all(account.scheduler.exhausted() for account in accounts):
+        ring.stop()
+    producer.join()
+    if journal:
+        journal.close()
+    if not TEST_RECIPIENT:
+        save_deferred(date_str, ring.unsent())
+
+    used = [connection.stats() for connection in connections if connection.sent or connection.failed or connection.busy_seconds]
+    SMTP_STATS.extend(used)
+    if not used:
+        if ring.deferred:
+            print("📧 所有发件账号今日额度已用尽或不可用，本次不发送")
+        elif journal and journal.skipped:
+            print(f"📧 今天的邮件已全部发送过 ({journal.skipped} 位)，跳过")
+        else:
+            print("⚠️ 没有收件人 (请配置 TEST_RECIPIENT 或 检查 Notion 连接)，跳过发送")
+        return
+    for entry in used:
+        print(f"📧 {entry['account']} 连接 #{entry['connection']}: 发送 {entry['sent']} 封 | 失败 {entry['failed']} | "
+              f"重连 {entry['reconnects']} | {entry['per_second']} 封/秒")
+    print(f"📧 邮件推送完成: 成功 {sum(e['sent'] for e in used)} 封，失败 {sum(e['failed'] for e in used)} 封")
+
+def load_state(name, default):
+    """读取 STATE_DIR 下的 JSON 状态文件，不存在或损坏时返回 default"""
+    path = os.path.join(STATE_DIR, name)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_state(name, data):
+    """原子写入 STATE_DIR 下的 JSON 状态文件"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = os.path.join(STATE_DIR, name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def completion_percentiles():
+    """根据历史运行记录估算 Deep Research 完成时间的中位数与 p90 (样本不足时 p90 取中位数的 1.5 倍)"""
+    history = load_state("deep_research_history.json", {})
+    durations = history.get("durations", [])
+    if not durations:
+        return DEFAULT_MEDIAN_COMPLETION, DEFAULT_MEDIAN_COMPLETION * 1.5
+    median = statistics.median(durations)
+    if len(durations) < 5:
+        return median, median * 1.5
+    return median, max(median, statistics.quantiles(durations, n=10)[-1])
+
+def record_research_run(interaction_id, transitions, elapsed=None):
+    """记录一次 Deep Research 的状态变化时间线，成功时同时记录耗时供后续估算中位数"""
+    history = load_state("deep_research_history.json", {})
+    if elapsed is not None:
+        history["durations"] = (history.get("durations", []) + [round(elapsed)])[-30:]
+    runs = history.get("runs", []) + [{"id": interaction_id, "transitions": transitions}]
+    history["runs"] = runs[-30:]
+    try:
+        save_state("deep_research_history.json", history)
+    except OSError as e:
+        print(f"⚠️ 保存 Deep Research 历史记录失败: {e}")
+
+def next_poll_interval(elapsed, last_interval, median, p90):
+    """
+    自适应轮询间隔：
+    - 启动后 POLL_WARMUP_SECONDS 内密集轮询，尽早发现快速失败
+    - 中段按指数退避 (带抖动)，减少无效的 API 调用
+    - 接近历史中位完成时间后恢复密集轮询，缩短"完成→被发现"的延迟
+    - 超过中位数后逐步放缓，到历史 p90 时达到 POLL_TAIL_INTERVAL，长尾任务不再持续密集轮询
+    """
+    late_phase_start = median * 0.8
+    if elapsed < POLL_WARMUP_SECONDS:
+        return POLL_FAST_INTERVAL
+    if elapsed >= median:
+        progress = min(1.0, (elapsed - median) / max(p90 - median, 1))
+        return POLL_FAST_INTERVAL + (POLL_TAIL_INTERVAL - POLL_FAST_INTERVAL) * progress
+    if elapsed >= late_phase_start:
+        return POLL_FAST_INTERVAL
+    interval = min(POLL_MAX_INTERVAL, max(POLL_FAST_INTERVAL, last_interval) * 2)
+    interval *= random.uniform(0.8, 1.2)
+    # 退避不能跨过密集轮询阶段的起点
+    return max(POLL_FAST_INTERVAL, min(interval, late_phase_start - elapsed))
+
+def llm_cache_key(model, prompt):
+    """缓存键: 模型/Agent 名称 + 当天日期 + prompt 内容的 SHA-256"""
+    current_date = datetime.now(TZ_CN).strftime('%Y-%m-%d')
+    digest = hashlib.sha256(f"{model}\0{current_date}\0{prompt}".encode("utf-8")).hexdigest()
+    return f"{current_date}_{model.replace('/', '_')}_{digest[:24]}"
+
+def llm_cache_get(key):
+    """读取缓存的原始响应文本，未命中或已过期时返回 None"""
+    if not LLM_CACHE_ENABLED:
+        return None
+    path = os.path.join(LLM_CACHE_DIR, key + ".json")
+    try:
+        if time.time() - os.path.getmtime(path) > LLM_CACHE_TTL:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["text"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def llm_cache_put(key, model, text):
+    """写入原始响应文本 (先写临时文件再替换，兼容分片并发写入)"""
+    if not LLM_CACHE_ENABLED or not text:
+        return
+    try:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=LLM_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"model": model, "created_at": datetime.now(TZ_CN).isoformat(timespec="seconds"),
+                       "text": text}, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(LLM_CACHE_DIR, key + ".json"))
+    except OSError as e:
+        print(f"⚠️ 写入 LLM 缓存失败: {e}")
+
+def evict_llm_cache():
+    """删除超过 LLM_CACHE_TTL 的缓存文件"""
+    if not os.path.isdir(LLM_CACHE_DIR):
+        return
+    removed = 0
+    for name in os.listdir(LLM_CACHE_DIR):
+        path = os.path.join(LLM_CACHE_DIR, name)
+        try:
+            if time.time() - os.path.getmtime(path) > LLM_CACHE_TTL:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    if removed:
+        print(f"🧹 已清理 {removed} 个过期的 LLM 缓存")
+
+LLM_CALLS = []
+SMTP_STATS = []     # 各 SMTP 连接的发送统计
+llm_calls_lock = threading.Lock()
+run_started_at = datetime.now(TZ_CN)
+
+def usage_counts(usage):
+    """从 generate_content 的 usage_metadata 或 interaction 的 usage 中提取 token 数"""
+    def pick(*names):
+        for name in names:
+            value = getattr(usage, name, None)
+            if value:
+                return value
+        return 0
+
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": pick("prompt_token_count", "total_input_tokens"),
+        "response_tokens": pick("candidates_token_count", "total_output_tokens"),
+        "thinking_tokens": pick("thoughts_token_count", "total_reasoning_tokens"),
+        "total_tokens": pick("total_token_count", "total_tokens"),
+    }
+
+def record_llm_call(label, model, elapsed, usage=None, **extra):
+    """记录一次模型调用 (线程安全，分片并发调用时也可使用)"""
+    counts = usage_counts(usage)
+    input_price, output_price = MODEL_PRICING.get(model, (0.0, 0.0))
+    cost = (counts.get("prompt_tokens", 0) * input_price +
+            (counts.get("response_tokens", 0) + counts.get("thinking_tokens", 0)) * output_price) / 1_000_000
+    entry = {
+        "label": label,
+        "model": model,
+        "started_at": (datetime.now(TZ_CN) - timedelta(seconds=elapsed)).isoformat(timespec="seconds"),
+        "seconds": round(elapsed, 2),
+        **counts,
+        "cost_usd": round(cost, 6),
+        **extra,
+    }
+    with llm_calls_lock:
+        LLM_CALLS.append(entry)
+    token_info = f" | {counts['prompt_tokens']} → {counts['response_tokens']} tokens" if counts else ""
+    print(f"📏 [{label}] {model}: {elapsed:.1f} 秒{token_info}")
+
+def write_run_report():
+    """汇总本次运行的模型调用统计，写入 RUN_REPORT_PATH"""
+    notion_stats = notion.stats()
+    if not LLM_CALLS and not notion_stats and not SMTP_STATS:
+        return
+    totals = {"calls": len(LLM_CALLS), "seconds": 0.0, "prompt_tokens": 0,
+              "response_tokens": 0, "thinking_tokens": 0, "cost_usd": 0.0}
+    for call in LLM_CALLS:
+        for key in totals:
+            if key != "calls":
+                totals[key] += call.get(key, 0)
+    totals["seconds"] = round(totals["seconds"], 2)
+    totals["cost_usd"] = round(totals["cost_usd"], 6)
+
+    report = {
+        "started_at": run_started_at.isoformat(timespec="seconds"),
+        "finished_at": datetime.now(TZ_CN).isoformat(timespec="seconds"),
+        "totals": totals,
+        "calls": LLM_CALLS,
+        "notion": notion_stats,
+        "smtp": SMTP_STATS,
+    }
+    try:
+        os.makedirs(os.path.dirname(RUN_REPORT_PATH) or ".", exist_ok=True)
+        with open(RUN_REPORT_PATH, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📏 模型调用统计: {totals['calls']} 次 | {totals['prompt_tokens']} → {totals['response_tokens']} tokens"
+              f" | 约 ${totals['cost_usd']:.4f} | 报告: {RUN_REPORT_PATH}")
+        for path, entry in notion_stats.items():
+            print(f"📓 Notion {path}: {entry['calls']} 次 | 重试 {entry['retries']} | 平均 {entry['avg_seconds']} 秒 | 最长 {entry['max_seconds']} 秒")
+    except OSError as e:
+        print(f"⚠️ 写入运行报告失败: {e}")
+
+def generate_text(model, contents, config=None, label="generate"):
+    """带磁盘缓存、重试和调用统计的 client.models.generate_content，返回响应文本"""
+    key = llm_cache_key(model, contents)
+    cached = llm_cache_get(key)
+    if cached is not None:
+        print(f"💾 命中 LLM 缓存: {model} ({key})")
+        record_llm_call(label, model, 0, prompt_chars=len(contents), cached=True)
+        return cached
+
+    start_time = time.time()
+    for attempt in range(LLM_RETRIES + 1):
+        try:
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+            break
+        except Exception as e:
+            if attempt == LLM_RETRIES:
+                record_llm_call(label, model, time.time() - start_time, prompt_chars=len(contents),
+                                retries=attempt, error=type(e).__name__)
+                raise
+            print(f"⚠️ [{label}] {model} 调用失败，{5 * (attempt + 1)} 秒后重试: {e}")
+            time.sleep(5 * (attempt + 1))
+
+    record_llm_call(label, model, time.time() - start_time, response.usage_metadata,
+                    prompt_chars=len(contents), retries=attempt)
+    llm_cache_put(key, model, response.text)
+    return response.text
+
+def resume_research_checkpoint(current_date, prompt_hash):
+    """
+    查找当天同一 prompt 的 Deep Research 断点并重新挂载
+    返回: (interaction, 创建时间戳)；没有可用断点时返回 (None, None)
+    """
+    checkpoint = load_state("deep_research_checkpoint.json", {})
+    if checkpoint.get("date") != current_date or checkpoint.get("prompt_hash") != prompt_hash:
+        return None, None
+
+    try:
+        interaction = client.interactions.get(checkpoint["interaction_id"])
+    except Exception as e:
+        print(f"⚠️ 无法重新挂载研究任务 {checkpoint['interaction_id']}: {e}")
+        return None, None
+
+    if interaction.status == "failed":
+        print("⚠️ 断点中的研究任务已失败，重新发起研究")
+        return None, None
+
+    print(f"♻️ 重新挂载今日研究任务: {interaction.id} (状态: {interaction.status})")
+    return interaction, checkpoint["created_at"]
+
+def save_research_checkpoint(current_date, prompt_hash, interaction_id, created_at):
+    """记录当天的 Deep Research 任务，供进程被杀或崩溃后的重跑复用"""
+    try:
+        save_state("deep_research_checkpoint.json", {
+            "date": current_date,
+            "prompt_hash": prompt_hash,
+            "interaction_id": interaction_id,
+            "created_at": created_at,
+        })
+    except OSError as e:
+        print(f"⚠️ 保存研究断点失败: {e}")
+
+def classify_research_error(error):
+    """将 Deep Research 的异常归类，便于判断是配额、权限还是超时问题"""
+    message = str(error).lower()
+    if any(k in message for k in ("429", "quota", "resource_exhausted", "rate limit")):
+        return "quota"
+    if any(k in message for k in ("401", "403", "permission", "allowlist", "unauthenticated")):
+        return "permission"
+    if "超时" in message or "timeout" in message:
+        return "timeout"
+    if "研究任务失败" in message:
+        return "agent_failed"
+    return type(error).__name__
+
+def deep_research_breaker_allows():
+    """熔断器检查：打开且仍在冷却期内时返回 False；冷却期已过则放行一次半开探测"""
+    breaker = load_state("deep_research_breaker.json", {})
+    failures = breaker.get("consecutive_failures", 0)
+    if failures < BREAKER_THRESHOLD:
+        return True
+
+    remaining = breaker.get("opened_at", 0) + BREAKER_COOLDOWN_HOURS * 3600 - time.time()
+    if remaining > 0:
+        print(f"🔌 Deep Research 熔断中 (连续失败 {failures} 次，最近错误: {breaker.get('last_error_class')})，"
+              f"{remaining / 3600:.1f} 小时后半开探测")
+        return False
+    print(f"🔌 熔断冷却期已过，本次 Deep Research 作为半开探测 (此前连续失败 {failures} 次)")
+    return True
+
+def record_deep_research_outcome(error=None):
+    """记录 Deep Research 的成败；连续失败达到阈值 (或半开探测失败) 时打开熔断器"""
+    breaker = load_state("deep_research_breaker.json", {})
+    if error is None:
+        if breaker.get("consecutive_failures"):
+            print("🔌 Deep Research 已恢复，熔断器闭合")
+        breaker = {"consecutive_failures": 0}
+    else:
+        failures = breaker.get("consecutive_failures", 0) + 1
+        breaker.update({
+            "consecutive_failures": failures,
+            "last_error_class": classify_research_error(error),
+            "last_error": str(error)[:300],
+            "last_failure_at": datetime.now(TZ_CN).isoformat(timespec="seconds"),
+        })
+        if failures >= BREAKER_THRESHOLD:
+            breaker["opened_at"] = time.time()
+            print(f"🔌 Deep Research 连续失败 {failures} 次，熔断器打开 {BREAKER_COOLDOWN_HOURS:.0f} 小时")
+    try:
+        save_state("deep_research_breaker.json", breaker)
+    except OSError as e:
+        print(f"⚠️ 保存熔断器状态失败: {e}")
+
+def run_deep_research(cancel_event=None, started_event=None):
     """
     使用 Gemini Deep Research Agent 进行深度研究
+    cancel_event: 可选，被 set 后停止轮询并抛出异常（对冲模式下由胜出方触发）
+    started_event: 可选，研究任务创建成功后 set，用于对冲模式计时
     返回: 原始研究报告文本
     """
     print("🔬 正在启动 Deep Research Agent...")
@@ -187,7 +1452,7 @@ You are a senior AI industry analyst tasked with creating a comprehensive daily
 5. **Community Discussions & Sentiment**
    - Hot topics on Reddit (r/LocalLlama, r/MachineLearning)
    - Hacker News discussions
-
+{coverage_exclusion_prompt()}
 ## Output Requirements
 
 ### Language
@@ -252,53 +1517,516 @@ Act as their personal AI intelligence officer. Spend the necessary time to thoro
     """
     
     try:
-        start_time = time.time()
+        # 已完成的报告直接从缓存回放
+        cache_key = llm_cache_key(DEEP_RESEARCH_AGENT, research_task)
+        cached = llm_cache_get(cache_key)
+        if cached is not None:
+            print(f"💾 命中 LLM 缓存: {DEEP_RESEARCH_AGENT} ({cache_key})")
+            record_llm_call("deep_research", DEEP_RESEARCH_AGENT, 0, prompt_chars=len(research_task), cached=True)
+            record_deep_research_outcome()
+            return cached
         
-        # 创建后台研究任务
-        interaction = client.interactions.create(
-            input=research_task,
-            agent='deep-research-pro-preview-12-2025',
-            background=True
-        )
+        # 同一天、同一 prompt 的任务优先复用，避免重跑时重复付费研究
+        prompt_hash = hashlib.sha256(research_task.encode("utf-8")).hexdigest()[:16]
+        interaction, start_time = resume_research_checkpoint(current_date, prompt_hash)
+        # 重跑时任务已经完成的话，耗时无法反映真实完成时间，不计入历史中位数
+        finished_before_resume = interaction is not None and interaction.status == "completed"
         
-        print(f"✅ 研究任务已启动: {interaction.id}")
+        if interaction is None:
+            start_time = time.time()
+            
+            # 创建后台研究任务
+            interaction = client.interactions.create(
+                input=research_task,
+                agent=DEEP_RESEARCH_AGENT,
+                background=True
+            )
+            save_research_checkpoint(current_date, prompt_hash, interaction.id, start_time)
+            
+            print(f"✅ 研究任务已启动: {interaction.id}")
         print("📊 任务状态监控中...")
+        if started_event:
+            started_event.set()
         
-        # 轮询检查任务状态
+        # 自适应轮询任务状态
+        median, p90 = completion_percentiles()
+        print(f"📈 历史完成时间: 中位 {median/60:.1f} 分钟 | p90 {p90/60:.1f} 分钟")
         poll_count = 0
+        poll_interval = 0
+        last_status = None
+        transitions = []
         while True:
+            if cancel_event and cancel_event.is_set():
+                raise Exception("对冲模式下已有其他报告胜出，停止轮询")
             poll_count += 1
             interaction = client.interactions.get(interaction.id)
             
             status = interaction.status
+            elapsed = time.time() - start_time
+            if status != last_status:
+                transitions.append([datetime.now(TZ_CN).isoformat(timespec="seconds"), status])
+                print(f"🔀 状态变化: {last_status} → {status} (第 {elapsed/60:.1f} 分钟)")
+                last_status = status
             
             if status == "completed":
-                elapsed = time.time() - start_time
-                print(f"✅ 研究完成！耗时: {elapsed/60:.1f} 分钟")
+                print(f"✅ 研究完成！耗时: {elapsed/60:.1f} 分钟 | 轮询次数: {poll_count}")
+                record_llm_call("deep_research", DEEP_RESEARCH_AGENT, elapsed, getattr(interaction, "usage", None),
+                                prompt_chars=len(research_task), polls=poll_count,
+                                resumed=finished_before_resume)
+                record_research_run(interaction.id, transitions,
+                                    None if finished_before_resume else elapsed)
                 
                 if interaction.outputs and len(interaction.outputs) > 0:
                     result = interaction.outputs[-1].text
                     print(f"📝 报告长度: {len(result)} 字符")
+                    llm_cache_put(cache_key, DEEP_RESEARCH_AGENT, result)
+                    record_deep_research_outcome()
                     return result
                 else:
                     raise Exception("研究完成但无输出内容")
                     
             elif status == "failed":
+                record_research_run(interaction.id, transitions)
+                record_llm_call("deep_research", DEEP_RESEARCH_AGENT, elapsed, getattr(interaction, "usage", None),
+                                prompt_chars=len(research_task), polls=poll_count, error="failed")
                 error_msg = getattr(interaction, 'error', '未知错误')
                 raise Exception(f"研究任务失败: {error_msg}")
                 
             else:
-                elapsed = time.time() - start_time
-                print(f"⏳ [{poll_count}] 状态: {status} | 已耗时: {elapsed/60:.1f} 分钟")
-                time.sleep(30)
+                if elapsed > DEEP_RESEARCH_TIMEOUT:
+                    record_research_run(interaction.id, transitions)
+                    raise Exception(f"任务超时（超过{DEEP_RESEARCH_TIMEOUT // 60}分钟）")
                 
-                if elapsed > 3600:
-                    raise Exception("任务超时（超过60分钟）")
+                poll_interval = next_poll_interval(elapsed, poll_interval, median, p90)
+                print(f"⏳ [{poll_count}] 状态: {status} | 已耗时: {elapsed/60:.1f} 分钟 | {poll_interval:.0f} 秒后再次检查")
+                if cancel_event:
+                    cancel_event.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
                     
     except Exception as e:
         print(f"❌ Deep Research 执行失败: {e}")
+        # 对冲模式下被胜出方取消不算失败
+        if not (cancel_event and cancel_event.is_set()):
+            record_deep_research_outcome(e)
         raise
+    finally:
+        # 任务未能创建时也要通知对冲调度，避免降级方案白等
+        if started_event:
+            started_event.set()
+
+
+class ReportLink:
+    """极客推荐 / 原始情报来源中的一行链接"""
+    __slots__ = ("title", "url", "note")
+
+    def __init__(self, title, url, note=""):
+        self.title = title
+        self.url = url
+        self.note = note
+
+    def __repr__(self):
+        return f"ReportLink({self.title!r}, {self.url!r})"
+
+class ReportItem:
+    """一条核心情报: 编号、标题、来源，以及标题之后的原始 Markdown 行"""
+    __slots__ = ("number", "title", "source_name", "source_url", "published", "lines")
+
+    def __init__(self, number, title):
+        self.number = number
+        self.title = title
+        self.source_name = None
+        self.source_url = None
+        self.published = None
+        self.lines = []
+
+    @property
+    def body(self):
+        return "\n".join(self.lines).strip()
+
+    def __repr__(self):
+        return f"ReportItem({self.number}, {self.title!r})"
+
+class ReportBlock:
+    """
+    正文中的一个块级元素 (Markdown AST 节点)
+    kind: 对应的 Notion block 类型 | text: 块内的行内 Markdown (代码块为原文) | end: 在正文中的结束位置
+    children: 嵌套的子块 (列表项下的子列表/段落) | language: 代码块语言
+    """
+    __slots__ = ("kind", "text", "end", "children", "language")
+
+    def __init__(self, kind, text, end=0, language=None):
+        self.kind = kind
+        self.text = text
+        self.end = end
+        self.children = []
+        self.language = language
+
+    def __repr__(self):
+        return f"ReportBlock({self.kind!r}, {self.text[:30]!r}, children={len(self.children)})"
+
+class Report:
+    """
+    解析后的简报，只解析一次，所有输出环节 (网页/首页/Notion/Issue/邮件) 共用
+    metadata: dict | content: 正文 Markdown | insight: 首席洞察段落
+    items: [ReportItem] | tools / sources: [ReportLink] | complete: 是否见到 ---END_CONTENT---
+    blocks / html: 按需生成一次并缓存的块级结构与 HTML 正文
+    """
+    __slots__ = ("metadata", "content", "insight", "items", "tools", "sources", "complete", "_blocks", "_html")
+
+    def __init__(self, metadata, content, insight="", items=None, tools=None, sources=None, complete=True):
+        self.metadata = metadata
+        self.content = content
+        self.insight = insight
+        self.items = items or []
+        self.tools = tools or []
+        self.sources = sources or []
+        self.complete = complete
+        self._blocks = None
+        self._html = None
+
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self._blocks = parse_markdown_blocks(self.content)
+        return self._blocks
+
+    @property
+    def html(self):
+        if self._html is None:
+            self._html = markdown.markdown(self.content)
+        return self._html
+
+    def __repr__(self):
+        return f"Report({self.metadata.get('title')!r}, items={len(self.items)}, complete={self.complete})"
+
+REPORT_MARKER = re.compile(r'---(START|END)_(METADATA|CONTENT)---')
+LINK_LINE = re.compile(r'^[-*]\s+(?:\*\*)?\[([^\]]+)\]\(([^)\s]+)\)(?:\*\*)?\s*[:：]?\s*(.*)$')
+SOURCE_LINE = re.compile(r'\*\*来源\*\*\s*[:：]\s*(.*)$')
+PUBLISHED = re.compile(r'发布时间\s*[:：]?\s*(.+)$')
+
+class StreamingReportParser:
+    """
+    单遍、增量的报告解析器：文本可以一次性传入，也可以按流式分片多次 feed()
+    - 按行切分并识别 METADATA/CONTENT 标记（标记与正文同行、被分片截断都能处理）
+    - 重复出现的标记：完整报告出现之前以后出现的为准（模型常先复述一遍模板），之后的忽略
+    - 正文按标题划分为 首席洞察 / 核心情报 / 极客推荐 / 原始情报来源，直接构建 Report
+    feed() 返回新产生的事件列表: ("metadata", dict) / ("item", 标题) / ("done", None)
+    strict=True 时（流式场景）格式明显出错立即抛出异常，调用方可中止流
+    """
+
+    def __init__(self, marker_deadline=None, strict=False):
+        self.marker_deadline = marker_deadline
+        self.strict = strict
+        self.buffer = ""
+        self.state = "preamble"   # preamble → metadata → between → content → done
+        self.metadata = None
+        self.error = None
+        self.items = []
+        self._line_start = 0      # 尚未处理的行的起点
+        self._state_start = 0     # 进入当前状态时的 buffer 位置
+        self._reset_metadata()
+        self._reset_content()
+
+    def _reset_metadata(self):
+        self.metadata = None
+        self._metadata_lines = []
+
+    def _reset_content(self):
+        self.items = []
+        self._content_lines = []
+        self._insight_lines = []
+        self._tools = []
+        self._sources = []
+        self._section = None
+
+    def feed(self, text):
+        self.buffer += text
+        events = []
+        while True:
+            newline = self.buffer.find("\n", self._line_start)
+            if newline == -1:
+                break
+            line = self.buffer[self._line_start:newline]
+            self._line_start = newline + 1
+            events.extend(self._handle_line(line))
+
+        if self.marker_deadline and self.state in ("preamble", "between", "metadata") and \
+                len(self.buffer) - self._state_start > self.marker_deadline:
+            raise Exception(f"流式输出格式异常: {self.marker_deadline} 字符内未出现预期标记 (当前阶段: {self.state})")
+        return events
+
+    def close(self):
+        """处理最后一行（可能没有换行符），返回剩余事件"""
+        events = self._handle_line(self.buffer[self._line_start:])
+        self._line_start = len(self.buffer)
+        if self.state == "content":
+            print("⚠️ 报告正文不完整，未见 ---END_CONTENT---")
+        return events
+
+    def report(self):
+        """构建 Report；没有合法 METADATA 或从未进入正文时返回 None"""
+        if self.metadata is None or self.state not in ("content", "done"):
+            return None
+        return Report(
+            metadata=self.metadata,
+            content="\n".join(self._content_lines).strip(),
+            insight="\n".join(self._insight_lines).strip(),
+            items=self.items,
+            tools=self._tools,
+            sources=self._sources,
+            complete=self.state == "done",
+        )
+
+    def _enter(self, state):
+        self.state = state
+        self._state_start = self._line_start
+
+    def _handle_line(self, line):
+        events = []
+        pos = 0
+        for match in REPORT_MARKER.finditer(line):
+            segment = line[pos:match.start()]
+            if segment.strip():
+                events.extend(self._handle_text(segment))
+            events.extend(self._handle_marker(match.group(1), match.group(2)))
+            pos = match.end()
+        if pos == 0:
+            events.extend(self._handle_text(line))
+        elif line[pos:].strip():
+            events.extend(self._handle_text(line[pos:]))
+        return events
+
+    def _handle_marker(self, kind, block):
+        if self.state == "done":
+            return []
+        if kind == "START" and block == "METADATA":
+            self._reset_metadata()
+            self._reset_content()
+            self._enter("metadata")
+        elif kind == "END" and block == "METADATA" and self.state == "metadata":
+            json_str = "\n".join(self._metadata_lines).strip()
+            json_str = re.sub(r'^```json|```$', '', json_str, flags=re.MULTILINE).strip()
+            try:
+                self.metadata = json.loads(json_str)
+            except ValueError as e:
+                self.error = f"METADATA 不是合法 JSON ({e})"
+                if self.strict:
+                    raise Exception(f"流式输出格式异常: {self.error}")
+                self._enter("preamble")
+                return []
+            self.error = None
+            self._enter("between")
+            return [("metadata", self.metadata)]
+        elif kind == "START" and block == "CONTENT" and self.state in ("between", "content"):
+            self._reset_content()
+            self._enter("content")
+        elif kind == "END" and block == "CONTENT" and self.state == "content":
+            self._enter("done")
+            return [("done", None)]
+        return []
+
+    def _handle_text(self, text):
+        if self.state == "metadata":
+            self._metadata_lines.append(text)
+        elif self.state == "content":
+            return self._handle_content_line(text)
+        return []
+
+    def _handle_content_line(self, raw_line):
+        self._content_lines.append(raw_line)
+        line = raw_line.strip()
+
+        numbered = re.match(r'^###\s+(\d+)\.\s*(.+)', line)
+        if numbered or (line.startswith("### ") and self._section == "items"):
+            if numbered:
+                number, title = int(numbered.group(1)), numbered.group(2).strip()
+            else:
+                number, title = len(self.items) + 1, line[4:].strip()
+            self._section = "items"
+            self.items.append(ReportItem(number, title))
+            return [("item", title)]
+
+        if line.startswith("## "):
+            if "核心情报" in line:
+                self._section = "items"
+            elif "极客推荐" in line or "Tools" in line:
+                self._section = "tools"
+            elif "来源" in line or "Sources" in line:
+                self._section = "sources"
+            else:
+                self._section = None
+        elif line.startswith("# "):
+            self._section = "insight" if ("洞察" in line or "Insight" in line) else None
+        elif self._section == "insight":
+            if line:
+                self._insight_lines.append(line)
+        elif self._section == "items" and self.items:
+            item = self.items[-1]
+            item.lines.append(line)
+            source = SOURCE_LINE.search(line) if item.source_name is None else None
+            if source:
+                # 来源可能是 [名称](URL)、多个链接以 | 分隔，或纯文本
+                text, _, published = source.group(1).partition(" | ")
+                link = re.search(r'\[([^\]]+)\]\(([^)\s]+)\)', text)
+                item.source_name, item.source_url = (link.group(1), link.group(2)) if link else (text.strip(), None)
+                match = PUBLISHED.search(source.group(1))
+                item.published = match.group(1).strip() if match else (published.strip() or None)
+        elif self._section in ("tools", "sources"):
+            link = LINK_LINE.match(line)
+            if link:
+                target = self._tools if self._section == "tools" else self._sources
+                target.append(ReportLink(link.group(1), link.group(2), link.group(3).strip()))
+        return []
+
+def stream_generate_report(model, contents, config=None, on_metadata=None, on_item=None):
+    """
+    流式版 generate_text：边接收边解析，METADATA 和每条情报到达时回调 on_metadata / on_item
+    返回完整的原始文本（同样写入 LLM 缓存）
+    """
+    key = llm_cache_key(model, contents)
+    cached = llm_cache_get(key)
+    if cached is not None:
+        print(f"💾 命中 LLM 缓存: {model} ({key})")
+        record_llm_call("fallback_stream", model, 0, prompt_chars=len(contents), cached=True)
+        return cached
+
+    start_time = time.time()
+    parser = StreamingReportParser(marker_deadline=STREAM_MARKER_DEADLINE, strict=True)
+    usage = None
+    stream = client.models.generate_content_stream(model=model, contents=contents, config=config)
+    for chunk in stream:
+        usage = getattr(chunk, "usage_metadata", None) or usage
+        events = parser.feed(chunk.text or "")
+        for event, value in events:
+            elapsed = time.time() - start_time
+            if event == "metadata":
+                print(f"📋 [{elapsed:.0f}s] 元数据已就绪: {value.get('title')}")
+                if on_metadata:
+                    on_metadata(value)
+            elif event == "item":
+                print(f"📰 [{elapsed:.0f}s] 收到情报: {value}")
+                if on_item:
+                    on_item(value)
+    parser.close()
+
+    record_llm_call("fallback_stream", model, time.time() - start_time, usage, prompt_chars=len(contents))
+    llm_cache_put(key, model, parser.buffer)
+    return parser.buffer
+
+def format_report_text(metadata, insight, item_blocks, tool_lines, source_lines):
+    """按标准的 METADATA/CONTENT 格式拼出原始报告文本（本地合成报告时使用）"""
+    return f"""---START_METADATA---
+{json.dumps(metadata, ensure_ascii=False, indent=2)}
+---END_METADATA---
+
+---START_CONTENT---
+# 💡 首席洞察 (Chief Insight)
+
+{insight}
+
+## 🔥 核心情报
+
+{chr(10).join(block + chr(10) for block in item_blocks).strip()}
+
+## 🛠️ 极客推荐 (GitHub/Tools)
 
+{chr(10).join(tool_lines)}
+
+## 🔗 原始情报来源
+
+{chr(10).join(source_lines)}
+---END_CONTENT---
+"""
+
+# 结构化输出的 JSON Schema：元数据 + 核心情报数组 (含来源 URL 与日期) + 极客推荐 + 来源
+REPORT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string", "description": "今日最有震撼力的头条标题（不超过 30 字）"},
+        "summary": {"type": "string", "description": "60-100 字的精准摘要，3-4 个核心要点，用分号分隔"},
+        "tags": {"type": "array", "items": {"type": "string"}},
+        "importance": {"type": "integer"},
+        "insight": {"type": "string", "description": "首席洞察：一段话合成今日的整体局势"},
+        "items": {
+            "type": "array",
+            "description": "4-6 条独立的核心情报",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "source_name": {"type": "string"},
+                    "source_url": {"type": "string"},
+                    "published": {"type": "string", "description": "发布日期 YYYY-MM-DD"},
+                    "analysis": {"type": "string", "description": "深度拆解"},
+                    "why_it_matters": {"type": "string", "description": "为何重要"},
+                    "community": {"type": "string", "description": "社区声音"},
+                },
+                "required": ["title", "source_name", "source_url", "published", "analysis", "why_it_matters"],
+            },
+        },
+        "tools": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": {"type": "string"}, "url": {"type": "string"}, "description": {"type": "string"}},
+                "required": ["name", "url", "description"],
+            },
+        },
+        "sources": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"title": {"type": "string"}, "url": {"type": "string"}},
+                "required": ["title", "url"],
+            },
+        },
+    },
+    "required": ["title", "summary", "tags", "insight", "items", "sources"],
+}
+
+STRUCTURED_OUTPUT_INSTRUCTION = """
+    # 输出要求
+    使用简体中文，按给定的 JSON Schema 输出，不要输出任何 JSON 以外的内容。
+    items 中每条情报都必须给出可验证的 source_url 与发布日期；sources 列出所有引用的来源。
+    """
+
+def render_structured_report(json_text):
+    """
+    将结构化输出的 JSON 在本地渲染为标准格式的原始报告文本
+    JSON 不合法或没有可用的核心情报时返回 None (由调用方退回文本格式)，其余缺失字段用默认值补齐
+    """
+    try:
+        data = json.loads(json_text)
+    except ValueError:
+        return None
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return None
+    items = [item for item in items if isinstance(item, dict) and item.get("title")]
+    if not items:
+        return None
+    metadata = {
+        "title": data.get("title") or items[0]["title"][:30],
+        "summary": data.get("summary") or "；".join(item["title"] for item in items[:4])[:100],
+        "tags": data.get("tags") or [],
+        "importance": data.get("importance", 8),
+    }
+    item_blocks = []
+    for i, item in enumerate(items, 1):
+        block = (f"### {i}. {item['title']}\n"
+                 f"**来源**: [{item.get('source_name') or '来源'}]({item.get('source_url', '')}) | "
+                 f"发布时间: {item.get('published', '')}\n\n"
+                 f"- **深度拆解**: {item.get('analysis', '')}\n\n"
+                 f"- **为何重要**: {item.get('why_it_matters', '')}")
+        if item.get("community"):
+            block += f"\n\n- **社区声音**: {item['community']}"
+        item_blocks.append(block)
+    tool_lines = [f"- **[{tool.get('name', '')}]({tool.get('url', '')})**: {tool.get('description', '')}"
+                  for tool in data.get("tools") or [] if isinstance(tool, dict)]
+    source_lines = [f"- [{source.get('title', '')}]({source.get('url', '')})"
+                    for source in data.get("sources") or [] if isinstance(source, dict)]
+    return format_report_text(metadata, data.get("insight", ""), item_blocks, tool_lines, source_lines)
 
 def run_gemini3_research_fallback():
     """
@@ -336,7 +2064,7 @@ def run_gemini3_research_fallback():
     - 官方源：`site:openai.com/blog`, `site:anthropic.com`
     - 资讯源：`AI news after:{yesterday}`, `VentureBeat AI`, `TechCrunch AI`
     - 社区源：`site:reddit.com/r/LocalLlama top 24h`, `site:news.ycombinator.com AI`, `site:huggingface.co/papers`
-    
+    {coverage_exclusion_prompt()}
     # 输出要求 (Markdown + JSON)
     你的输出必须包含【思考过程】并严格遵守以下格式：
     
@@ -378,102 +2106,662 @@ def run_gemini3_research_fallback():
     ---END_CONTENT---
     """
 
-    response = client.models.generate_content(
+    if STRUCTURED_OUTPUT:
+        # 用 JSON Schema 约束输出，替换掉 prompt 中的文本格式约定
+        structured_prompt = prompt.split("    # 输出要求")[0] + STRUCTURED_OUTPUT_INSTRUCTION
+        json_text = generate_text(
+            model='gemini-3-pro-preview',
+            contents=structured_prompt,
+            config=types.GenerateContentConfig(
+                tools=[types.Tool(google_search=types.GoogleSearch())],
+                response_mime_type="application/json",
+                response_schema=REPORT_SCHEMA
+            ),
+            label="fallback_structured"
+        )
+        report_text = render_structured_report(json_text)
+        if report_text:
+            return report_text
+        print("⚠️ 结构化输出缺少必要字段，改用文本格式重新生成")
+
+    config = types.GenerateContentConfig(
+        tools=[types.Tool(google_search=types.GoogleSearch())],
+        thinking_config=types.ThinkingConfig(include_thoughts=True)  # 启用思考模式
+    )
+    if FALLBACK_STREAM:
+        return stream_generate_report('gemini-3-pro-preview', prompt, config)
+    return generate_text(
         model='gemini-3-pro-preview',  # 使用与原版相同的模型
         contents=prompt,
+        config=config,
+        label="fallback"
+    )
+
+def submit_daemon(fn, *args):
+    """
+    在守护线程中执行 fn(*args)，返回 Future (可用于 wait)
+    ThreadPoolExecutor 的线程会在解释器退出时被 join，卡住的落败方会拖住整个进程；守护线程不会
+    """
+    future = Future()
+
+    def runner():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=runner, daemon=True).start()
+    return future
+
+def run_hedged_research(hedge_delay):
+    """
+    对冲执行：Deep Research 启动 hedge_delay 秒后并行启动降级方案
+    第一个能被 parse_report 完整解析的报告胜出，另一方被取消或忽略
+    返回: 原始研究报告文本
+    """
+    print(f"🏁 对冲模式: Deep Research 启动 {hedge_delay:.0f} 秒后并行启动降级方案")
+    cancel_event = threading.Event()
+    started_event = threading.Event()
+    # 两方都在守护线程中运行：胜出后不必等待落败方 (如卡住的 interactions.get) 结束即可退出进程
+    futures = {submit_daemon(run_deep_research, cancel_event, started_event): "Deep Research"}
+    unparsed_report = None
+    try:
+        # 从研究任务真正创建后才开始计时；创建请求本身卡住超过 hedge_delay 时立即启动降级方案
+        if started_event.wait(timeout=hedge_delay):
+            done, _ = wait(futures, timeout=hedge_delay)
+        else:
+            print(f"⚠️ Deep Research 任务 {hedge_delay:.0f} 秒内未能创建")
+            done = set()
+
+        fallback_started = False
+        while True:
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    raw_report = future.result()
+                except Exception as e:
+                    print(f"⚠️ {name} 失败: {e}")
+                    continue
+                report = parse_report(raw_report)
+                if report and report.complete:
+                    print(f"🏆 {name} 率先产出合格报告")
+                    return raw_report
+                print(f"⚠️ {name} 的报告格式不合格")
+                if unparsed_report is None:
+                    unparsed_report = raw_report
+
+            # 计时到期，或 Deep Research 提前结束但没有合格报告
+            if not fallback_started:
+                print("🔄 启动并行降级方案...")
+                futures[submit_daemon(run_fallback_research)] = "降级方案"
+                fallback_started = True
+
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+    finally:
+        cancel_event.set()
+        # 已在运行的落败方 (如降级方案的 generate_content) 无法中断，由守护线程跑完，这里取走它的结果 / 异常后丢弃
+        for future in futures:
+            future.add_done_callback(lambda f: f.exception())
+
+    # 两方都未产出格式合格的报告时，退回到未解析的原始报告（与串行模式一致）
+    if unparsed_report is not None:
+        return unparsed_report
+    raise Exception("Deep Research 与降级方案均失败")
+
+def run_fallback_research():
+    """按 FALLBACK_MODE 选择降级方案的执行方式"""
+    if FALLBACK_MODE == "sharded":
+        return run_sharded_research()
+    return run_gemini3_research_fallback()
+
+def run_research_shard(shard, current_date, yesterday):
+    """对单个覆盖领域执行一次 generate_content 研究，返回原始分片文本"""
+    prompt = f"""
+    # 角色定义
+    你是 AI 行业【首席情报官】团队中负责「{shard['name']}」方向的分析师。
+    
+    # 时效与环境
+    今天是 {current_date}。
+    你的搜索范围是 {yesterday} 至今。
+    
+    # 你的任务
+    只关注：{shard['focus']}。
+    找出该方向 1-2 条最重要且可验证的情报。优先级：真实性 > 新鲜度 > 完整性
+    {coverage_exclusion_prompt()}
+    # 输出要求 (简体中文，严格遵守以下格式，不要输出其他内容)
+    ---SHARD_INSIGHT---
+    (一句话总结该方向今日的整体动向)
+    ---SHARD_ITEMS---
+    ### [情报标题]
+    **来源**: [媒体/社区名称](URL) | 发布时间
+    
+    - **深度拆解**: (50-100字，核心技术或事件脉络)
+    
+    - **为何重要**: (一句话点出说明对行业的短期和长期影响。)
+    
+    - **社区声音**: (Reddit、Hacker News、Twitter 上的关键争议或好评)
+    ---SHARD_TOOLS---
+    - **[项目名](URL)**: (仅在发现值得推荐的开源项目时填写，否则留空)
+    ---SHARD_SOURCES---
+    - [标题](URL)
+    ---END_SHARD---
+    """
+
+    return generate_text(
+        model='gemini-3-pro-preview',
+        contents=prompt,
         config=types.GenerateContentConfig(
             tools=[types.Tool(google_search=types.GoogleSearch())],
-            thinking_config=types.ThinkingConfig(include_thoughts=True)  # 启用思考模式
-        )
+        ),
+        label=f"shard:{shard['tag']}"
     )
-    return response.text
 
-def parse_gemini_response(raw_text):
-    """从原始文本中提取元数据和正文内容"""
+def dedent_lines(text):
+    """去掉每行的首尾空白（模型常按 prompt 的缩进输出），保留空行结构"""
+    return "\n".join(line.strip() for line in text.strip().splitlines())
+
+def first_url(text):
+    """返回 Markdown 文本中第一个链接的 URL（规范化后用于去重）"""
+    match = re.search(r'\]\((https?://[^)\s]+)\)', text)
+    return match.group(1).rstrip("/") if match else None
+
+def parse_research_shard(raw_text):
+    """将分片文本拆分为 insight / items / tools / sources 四部分"""
+    sections = dict.fromkeys(["INSIGHT", "ITEMS", "TOOLS", "SOURCES"], "")
+    body = raw_text.split("---END_SHARD---")[0]
+    parts = re.split(r'^\s*---SHARD_(INSIGHT|ITEMS|TOOLS|SOURCES)---\s*$', body, flags=re.MULTILINE)
+    for name, text in zip(parts[1::2], parts[2::2]):
+        sections[name] = text.strip()
+
+    items = []
+    for chunk in re.split(r'^\s*###\s+', sections["ITEMS"], flags=re.MULTILINE)[1:]:
+        title, _, item_body = chunk.partition("\n")
+        title = re.sub(r'^\d+\.\s*', '', title.strip())
+        if title:
+            items.append((title, dedent_lines(item_body)))
+
+    return {
+        "insight": sections["INSIGHT"],
+        "items": items,
+        "tools": [line.strip() for line in sections["TOOLS"].splitlines() if line.strip().startswith(("- ", "* "))],
+        "sources": [line.strip() for line in sections["SOURCES"].splitlines() if line.strip().startswith(("- ", "* "))],
+    }
+
+def merge_research_shards(shard_results):
+    """
+    合并各分片结果：按领域优先级排列情报，按 URL/标题去重，
+    并生成与 parse_gemini_response 兼容的 METADATA/CONTENT 文本
+    """
+    insights, items, tools, sources, tags = [], [], [], [], []
+    seen_items, seen_tools, seen_sources = set(), set(), set()
+
+    for shard, result in shard_results:
+        if result["insight"]:
+            insights.append(result["insight"])
+        if result["items"]:
+            tags.append(shard["tag"])
+        for title, body in result["items"]:
+            key = first_url(body) or title
+            if key in seen_items or title in seen_items:
+                continue
+            seen_items.update([key, title])
+            items.append((title, body))
+        for line in result["tools"]:
+            key = first_url(line) or line
+            if key not in seen_tools:
+                seen_tools.add(key)
+                tools.append(line)
+        for line in result["sources"]:
+            key = first_url(line) or line
+            if key not in seen_sources:
+                seen_sources.add(key)
+                sources.append(line)
+
+    if not items:
+        raise Exception("所有分片均未产出有效情报")
+
+    metadata = {
+        "title": items[0][0][:30],
+        "summary": "；".join(title for title, _ in items[:4])[:100],
+        "tags": tags,
+        "importance": 8
+    }
+    item_blocks = [f"### {i}. {title}\n{body}" for i, (title, body) in enumerate(items, 1)]
+    return format_report_text(metadata, "\n\n".join(insights), item_blocks, tools, sources)
+
+def run_sharded_research():
+    """
+    分片并行研究：每个覆盖领域单独发起一次 generate_content，并发执行
+    总耗时取决于最慢的分片；超时或失败的分片直接丢弃，不阻塞整份简报
+    """
+    print(f"🧩 使用分片并行研究: {len(RESEARCH_SHARDS)} 个领域，单分片超时 {SHARD_TIMEOUT} 秒")
+    current_date = datetime.now(TZ_CN).strftime('%Y-%m-%d')
+    yesterday = (datetime.now(TZ_CN) - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    # 分片在守护线程中运行，超时丢弃的分片不会在进程退出时被等待
+    futures = {submit_daemon(run_research_shard, shard, current_date, yesterday): shard
+               for shard in RESEARCH_SHARDS}
+    done, not_done = wait(futures, timeout=SHARD_TIMEOUT)
+    for future in not_done:
+        future.add_done_callback(lambda f: f.exception())
+
+    shard_results = []
+    for future, shard in futures.items():
+        if future in not_done:
+            print(f"⏰ 分片超时，已丢弃: {shard['name']}")
+            continue
+        try:
+            result = parse_research_shard(future.result())
+            print(f"✅ 分片完成: {shard['name']} ({len(result['items'])} 条情报)")
+            shard_results.append((shard, result))
+        except Exception as e:
+            print(f"⚠️ 分片失败: {shard['name']} - {e}")
+
+    return merge_research_shards(shard_results)
+
+def headline_fingerprint(title):
+    """标题指纹: 去掉编号、标点与空白并转小写，用于跨天比对"""
+    title = re.sub(r'^\d+\.\s*', '', title)
+    return re.sub(r'[\W_]+', '', title).lower()
+
+def headline_similarity(a, b):
+    """两个标题指纹的字符 bigram Jaccard 相似度；包含的数字 (版本号等) 不同时为 0"""
+    if re.findall(r'\d+', a) != re.findall(r'\d+', b):
+        return 0.0
+    grams_a = {a[i:i + 2] for i in range(len(a) - 1)}
+    grams_b = {b[i:i + 2] for i in range(len(b) - 1)}
+    if not grams_a or not grams_b:
+        return 1.0 if a == b else 0.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+def extract_coverage(markdown_text):
+    """从一期报告中提取核心情报 (标题指纹, 标题, 来源 URL) 以及全部引用 URL"""
+    items = []
+    for match in re.finditer(r'^###\s+\d+\.\s*(.+)$\n((?:(?!^#{1,3} ).*\n?)*)', markdown_text, re.MULTILINE):
+        title = match.group(1).strip()
+        items.append([headline_fingerprint(title), title, first_url(match.group(2))])
+    urls = sorted({url.rstrip("/") for url in re.findall(r'\]\((https?://[^)\s]+)\)', markdown_text)})
+    return {"items": items, "urls": urls}
+
+def load_coverage_index(archive_dir="docs/archives"):
+    """
+    维护已报道情报的持久化索引 (STATE_DIR/coverage_index.json)
+    只解析新增或修改过的归档文件，返回 {日期: {"items": [...], "urls": [...]}}
+    """
+    index = load_state("coverage_index.json", {})
+    if not os.path.isdir(archive_dir):
+        return index
+
+    changed = False
+    for file in os.listdir(archive_dir):
+        if not re.match(r'^\d{4}-\d{2}-\d{2}\.md$', file):
+            continue
+        path = os.path.join(archive_dir, file)
+        mtime = os.path.getmtime(path)
+        date_str = file[:-3]
+        if index.get(date_str, {}).get("mtime") == mtime:
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            index[date_str] = dict(extract_coverage(f.read()), mtime=mtime)
+        changed = True
+
+    if changed:
+        try:
+            save_state("coverage_index.json", index)
+        except OSError as e:
+            print(f"⚠️ 保存已报道情报索引失败: {e}")
+    return index
+
+@functools.lru_cache(maxsize=1)
+def recent_coverage():
+    """近 COVERAGE_LOOKBACK_DAYS 天 (不含今天) 已报道的情报，以及这些情报的来源 URL (不含极客推荐与来源列表)"""
+    if COVERAGE_LOOKBACK_DAYS <= 0:
+        return [], set()
+    today = datetime.now(TZ_CN).date()
+    earliest = (today - timedelta(days=COVERAGE_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+    items, urls = [], set()
+    for date_str, entry in sorted(load_coverage_index().items(), reverse=True):
+        if earliest <= date_str < today.strftime('%Y-%m-%d'):
+            items.extend(entry["items"])
+            urls.update(url.rstrip("/") for _, _, url in entry["items"] if url)
+    return items, urls
+
+def coverage_exclusion_prompt():
+    """生成注入 prompt 的排除列表；没有历史记录时返回空字符串"""
+    items, _ = recent_coverage()
+    if not items:
+        return ""
+    lines = [f"    - {title}" + (f" ({url})" if url else "") for _, title, url in items[:COVERAGE_MAX_PROMPT_ITEMS]]
+    return (f"\n    # 已报道情报 (近 {COVERAGE_LOOKBACK_DAYS} 天，除非有实质性新进展，请勿重复报道)\n"
+            + "\n".join(lines) + "\n")
+
+def is_covered(title, url):
+    """判断一条情报是否已在近期报道过 (与某条已报道情报的来源 URL 完全相同，或标题指纹高度相近)"""
+    items, urls = recent_coverage()
+    if url and url.rstrip("/") in urls:
+        return True
+    fingerprint = headline_fingerprint(title)
+    return any(headline_similarity(fingerprint, past) >= HEADLINE_SIMILARITY for past, _, _ in items)
+
+def drop_covered_items(report):
+    """移除已报道过的 "### N." 核心情报并重新编号，返回新的 Report；全部命中时保留原文"""
+    blocks = re.split(r'(?=^#{1,3} )', report.content, flags=re.MULTILINE)
+    kept, dropped, number = [], [], 0
+    for block in blocks:
+        match = re.match(r'^###\s+\d+\.\s*(.+)', block)
+        if not match:
+            kept.append(block)
+            continue
+        title = match.group(1).strip()
+        if is_covered(title, first_url(block)):
+            dropped.append(title)
+            continue
+        number += 1
+        kept.append(re.sub(r'^###\s+\d+\.', f'### {number}.', block, count=1))
+
+    if not dropped:
+        return report
+    if number == 0:
+        print("⚠️ 所有核心情报均与近期报道重复，保留原文")
+        return report
+    for title in dropped:
+        print(f"♻️ 移除已报道情报: {title}")
+    items = [item for item in report.items if item.title not in dropped]
+    for number, item in enumerate(items, 1):
+        item.number = number
+    metadata = report.metadata
+    if report.items and report.items[0].title in dropped and items:
+        # 头条被移除：标题与摘要改用剩余情报重新生成
+        metadata = dict(metadata, title=items[0].title[:30],
+                        summary="；".join(item.title for item in items[:4])[:100])
+    return Report(metadata, "".join(kept), report.insight, items,
+                  report.tools, report.sources, report.complete)
+
+def parse_report(raw_text):
+    """单遍解析原始报告，返回 Report；找不到合法的 METADATA/CONTENT 时返回 None"""
     try:
-        metadata_match = re.search(r'---START_METADATA---(.*?)---END_METADATA---', raw_text, re.DOTALL)
-        content_match = re.search(r'---START_CONTENT---(.*?)---END_CONTENT---', raw_text, re.DOTALL)
-        
-        if metadata_match and content_match:
-            json_str = metadata_match.group(1).strip()
-            # 清理 JSON 中可能包裹的 markdown 代码块标识
-            json_str = re.sub(r'^```json|```$', '', json_str, flags=re.MULTILINE).strip()
-            metadata = json.loads(json_str)
-            content = content_match.group(1).strip()
-            return metadata, content
-        else:
-            return None, raw_text
+        parser = StreamingReportParser()
+        parser.feed(raw_text)
+        parser.close()
+        if parser.error:
+            print(f"⚠️ 解析出错: {parser.error}")
+        return parser.report()
     except Exception as e:
-        print(f"⚠️ 解析解析出错: {e}")
-        return None, raw_text
+        print(f"⚠️ 解析出错: {e}")
+        return None
 
-def split_content_to_blocks(text):
+def parse_gemini_response(raw_text):
+    """从原始文本中提取元数据和正文内容"""
+    report = parse_report(raw_text)
+    if report is None:
+        return None, raw_text
+    return report.metadata, report.content
+
+MD_FENCE = re.compile(r'^(`{3,}|~{3,})\s*([\w+#.-]*)')
+MD_HEADING = re.compile(r'^(#{1,6})\s+(.*?)(?:\s+#+)?$')
+MD_DIVIDER = re.compile(r'^(?:-{3,}|\*{3,}|_{3,})$')
+MD_LIST_ITEM = re.compile(r'^(?:([-*+])|\d{1,9}[.)])\s+(.*)$')
+MD_QUOTE = re.compile(r'^>\s?(.*)$')
+INLINE_MARKDOWN = re.compile(
+    r'\[(?P<label>[^\]]+)\]\((?P<url>[^)\s]+)\)'
+    r'|`(?P<code>[^`]+)`'
+    r'|\*\*(?P<bold>.+?)\*\*'
+    r'|~~(?P<strikethrough>.+?)~~'
+    r'|(?<![\w*])\*(?P<italic>[^*\s](?:[^*]*[^*\s])?)\*(?![\w*])'
+)
+
+NOTION_TEXT_LIMIT = 2000        # 单个 rich_text 元素的字符上限
+NOTION_RICH_TEXT_LIMIT = 100    # 单个 block 的 rich_text 元素上限
+NOTION_NESTING_LIMIT = 2        # 单次请求允许的子块嵌套层数
+NOTION_CODE_LANGUAGES = {
+    "": "plain text", "py": "python", "python": "python", "js": "javascript", "javascript": "javascript",
+    "ts": "typescript", "typescript": "typescript", "json": "json", "sh": "shell", "shell": "shell",
+    "bash": "bash", "yaml": "yaml", "yml": "yaml", "sql": "sql", "html": "html", "css": "css",
+    "go": "go", "rust": "rust", "java": "java", "c": "c", "cpp": "c++", "c++": "c++", "markdown": "markdown",
+}
+
+def parse_markdown_blocks(text):
     """
-    将 Markdown 文本转换为 Notion 的结构化 Block
-    支持：Heading 1/2/3, Bullet List, Quote, Paragraph
+    单遍扫描 Markdown 正文，生成块级 AST [ReportBlock]
+    支持：Heading, 无序/有序列表 (按缩进嵌套), Quote, 代码块, 分隔线, 段落 (连续行合并)
     """
     blocks = []
-    lines = text.split('\n')
-    
-    for line in lines:
-        line = line.strip()
-        if not line: 
+    open_items = []   # 当前列表的嵌套路径 [(缩进, ReportBlock)]
+    current = None    # 可被下一行接续的块 (段落 / 列表项 / 引用)
+    fence = None      # 未闭合的代码块 (围栏, 缩进, ReportBlock, 代码行)
+    pos = 0
+
+    def attach(block, indent):
+        while open_items and open_items[-1][0] >= indent:
+            open_items.pop()
+        (open_items[-1][1].children if open_items else blocks).append(block)
+
+    for raw_line in text.split('\n'):
+        pos += len(raw_line) + 1
+        expanded = raw_line.expandtabs(4)
+        line = expanded.strip()
+        indent = len(expanded) - len(expanded.lstrip())
+
+        if fence:
+            marker, fence_indent, block, code_lines = fence
+            if line.startswith(marker) and not line.strip(marker[0]):
+                block.text = "\n".join(code_lines)
+                fence = None
+            else:
+                code_lines.append(expanded[min(indent, fence_indent):].rstrip())
+        elif not line:
+            current = None
             continue
-        
-        # 1. Heading 1 (# )
-        if line.startswith('# '):
-            content = line[2:].strip()[:2000]
-            blocks.append({
-                "object": "block", "type": "heading_1",
-                "heading_1": {"rich_text": [{"text": {"content": content}}]}
-            })
-        # 2. Heading 2 (## )
-        elif line.startswith('## '):
-            content = line[3:].strip()[:2000]
-            blocks.append({
-                "object": "block", "type": "heading_2",
-                "heading_2": {"rich_text": [{"text": {"content": content}}]}
-            })
-        # 3. Heading 3 (### )
-        elif line.startswith('### '):
-            content = line[4:].strip()[:2000]
-            blocks.append({
-                "object": "block", "type": "heading_3",
-                "heading_3": {"rich_text": [{"text": {"content": content}}]}
-            })
-        # 4. Bullet List (- or * )
-        elif line.startswith('- ') or line.startswith('* '):
-            content = line[2:].strip()[:2000]
-            blocks.append({
-                "object": "block", "type": "bulleted_list_item",
-                "bulleted_list_item": {"rich_text": [{"text": {"content": content}}]}
-            })
-        # 5. Quote (> )
-        elif line.startswith('> '):
-            content = line[2:].strip()[:2000]
-            blocks.append({
-                "object": "block", "type": "quote",
-                "quote": {"rich_text": [{"text": {"content": content}}]}
-            })
-        # 6. Default Paragraph
+        elif MD_FENCE.match(line):
+            match = MD_FENCE.match(line)
+            block = ReportBlock("code", "", language=match.group(2).lower())
+            attach(block, indent)
+            fence = (match.group(1), indent, block, [])
+            current = None
+        elif MD_HEADING.match(line) and indent < 4:
+            match = MD_HEADING.match(line)
+            open_items.clear()
+            blocks.append(ReportBlock(f"heading_{min(len(match.group(1)), 3)}", match.group(2)))
+            current = None
+        elif MD_DIVIDER.match(line):
+            open_items.clear()
+            blocks.append(ReportBlock("divider", ""))
+            current = None
+        elif MD_LIST_ITEM.match(line):
+            match = MD_LIST_ITEM.match(line)
+            kind = "bulleted_list_item" if match.group(1) else "numbered_list_item"
+            current = ReportBlock(kind, match.group(2).strip())
+            attach(current, indent)
+            open_items.append((indent, current))
+        elif MD_QUOTE.match(line) and not (current and current.kind == "quote"):
+            current = ReportBlock("quote", MD_QUOTE.match(line).group(1).strip())
+            attach(current, indent)
+        elif current is not None:
+            quote = MD_QUOTE.match(line) if current.kind == "quote" else None
+            current.text += "\n" + (quote.group(1).strip() if quote else line)
         else:
-            # Notion block character limit is 2000
-            content = line[:2000]
-            blocks.append({
-                "object": "block", "type": "paragraph",
-                "paragraph": {"rich_text": [{"text": {"content": content}}]}
-            })
-            
+            current = ReportBlock("paragraph", line)
+            attach(current, indent)
+        blocks[-1].end = min(pos, len(text))
+
+    if fence:
+        # 未闭合的代码块保留到正文结尾
+        fence[2].text = "\n".join(fence[3])
     return blocks
 
-def save_to_notion(metadata, content):
-    """将已解析的内容同步到 Notion"""
+def text_runs(content, annotations=None, link=None):
+    """生成 rich_text 元素，超过 2000 字符的文本拆分为多段而不是截断"""
+    runs = []
+    for i in range(0, len(content), NOTION_TEXT_LIMIT):
+        run = {"type": "text", "text": {"content": content[i:i + NOTION_TEXT_LIMIT]}}
+        if link:
+            run["text"]["link"] = {"url": link}
+        if annotations:
+            run["annotations"] = dict(annotations)
+        runs.append(run)
+    return runs
+
+def inline_rich_text(text, annotations=None, link=None):
+    """将行内 Markdown (链接、加粗、斜体、删除线、行内代码，可相互嵌套) 转换为 Notion rich_text"""
+    runs = []
+    pos = 0
+    for match in INLINE_MARKDOWN.finditer(text):
+        if match.start() > pos:
+            runs.extend(text_runs(text[pos:match.start()], annotations, link))
+        style = match.lastgroup
+        if style == "url":
+            url = match.group("url")
+            valid = url.startswith(("http://", "https://")) and len(url) <= NOTION_TEXT_LIMIT
+            runs.extend(inline_rich_text(match.group("label"), annotations, url if valid else link))
+        elif style == "code":
+            runs.extend(text_runs(match.group("code"), dict(annotations or {}, code=True), link))
+        else:
+            runs.extend(inline_rich_text(match.group(style), dict(annotations or {}, **{style: True}), link))
+        pos = match.end()
+    if pos < len(text):
+        runs.extend(text_runs(text[pos:], annotations, link))
+    return runs
+
+def render_notion_blocks(blocks, depth=0):
+    """
+    将块级 AST 渲染为 Notion Block
+    rich_text 超过 100 段时拆成多个同类型 block；超出单次请求嵌套层数的子块提升为同级
+    """
+    rendered = []
+    for block in blocks:
+        if block.kind == "divider":
+            rendered.append({"object": "block", "type": "divider", "divider": {}})
+            continue
+        if block.kind == "code":
+            runs = text_runs(block.text)
+            payload = {"language": NOTION_CODE_LANGUAGES.get(block.language, "plain text")}
+        else:
+            runs = inline_rich_text(block.text)
+            payload = {}
+        for i in range(0, max(len(runs), 1), NOTION_RICH_TEXT_LIMIT):
+            rendered.append({
+                "object": "block", "type": block.kind,
+                block.kind: dict(payload, rich_text=runs[i:i + NOTION_RICH_TEXT_LIMIT])
+            })
+        if block.children:
+            children = render_notion_blocks(block.children, depth + 1)
+            if depth < NOTION_NESTING_LIMIT:
+                rendered[-1][block.kind]["children"] = children
+            else:
+                rendered.extend(children)
+    return rendered
+
+def split_content_to_blocks(text):
+    """将 Markdown 文本转换为 Notion 的结构化 Block"""
+    return render_notion_blocks(parse_markdown_blocks(text))
+
+def render_preview(report, limit=600):
+    """截取正文开头不超过 limit 字符的完整块作为预览，避免从链接或加粗中间截断"""
+    if len(report.content) <= limit:
+        return report.content
+    end = 0
+    for block in report.blocks:
+        if block.end > limit:
+            break
+        end = block.end
+    return (report.content[:end].rstrip() if end else report.content[:limit]) + "..."
+
+def append_notion_blocks(page_id, blocks, on_batch=None):
+    """
+    按 NOTION_BATCH_SIZE 分批、按顺序追加到页面末尾；某一批最终失败时抛出，前面的批次保留
+    on_batch(batch, results) 在每批成功后调用，results 为新建的顶层 block
+    """
+    batches = [blocks[i:i + NOTION_BATCH_SIZE] for i in range(0, len(blocks), NOTION_BATCH_SIZE)]
+    for number, batch in enumerate(batches, 1):
+        try:
+            resp = notion.blocks.children.append(block_id=page_id, children=batch)
+        except Exception as e:
+            synced = (number - 1) * NOTION_BATCH_SIZE
+            raise Exception(f"第 {number}/{len(batches)} 批 block 追加失败 (已追加 {synced} 个): {e}")
+        if on_batch:
+            on_batch(batch, resp.get("results", []))
+
+def notion_block_hash(block):
+    """渲染后 block (含子块) 的内容哈希，用于与上次同步的内容比对"""
+    return hashlib.sha256(json.dumps(block, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def find_notion_page(state, publish_date):
+    """按 发布日期 在简报数据库中查找已有页面，返回 page_id 或 None"""
+    if not state.get("data_source_id"):
+        database = notion.databases.retrieve(database_id=DATABASE_ID)
+        sources = database.get("data_sources") or [{"id": DATABASE_ID}]
+        state["data_source_id"] = sources[0]["id"]
+    resp = notion.data_sources.query(
+        data_source_id=state["data_source_id"],
+        filter={"property": "发布日期", "date": {"equals": publish_date}},
+        page_size=10
+    )
+    pages = [page for page in resp.get("results", []) if not (page.get("archived") or page.get("in_trash"))]
+    if len(pages) > 1:
+        print(f"⚠️ Notion 中 {publish_date} 已有 {len(pages)} 个页面，更新最早创建的一个")
+        pages.sort(key=lambda page: page.get("created_time", ""))
+    return pages[0]["id"] if pages else None
+
+def list_notion_children(page_id):
+    """列出页面的全部顶层 block id"""
+    block_ids, start_cursor = [], None
+    while True:
+        kwargs = {"block_id": page_id, "page_size": 100}
+        if start_cursor:
+            kwargs["start_cursor"] = start_cursor
+        resp = notion.blocks.children.list(**kwargs)
+        block_ids.extend(block["id"] for block in resp.get("results", []))
+        if not resp.get("has_more"):
+            return block_ids
+        start_cursor = resp.get("next_cursor")
+
+def sync_notion_blocks(entry, blocks):
+    """
+    只替换变化的部分：保留与上次同步内容相同的前缀，删除其后的旧 block，再分批追加新内容
+    entry["blocks"] 为 [[block_id, 哈希]]，每一步成功后即时更新，中途失败时下次从断点继续
+    """
+    hashes = [notion_block_hash(block) for block in blocks]
+    old = entry["blocks"]
+    keep = 0
+    while keep < min(len(old), len(hashes)) and old[keep][1] == hashes[keep]:
+        keep += 1
+    if keep == len(old) == len(hashes):
+        print("📓 Notion 页面内容无变化")
+        return
+
+    print(f"📓 保留 {keep} 个未变化的 block，删除 {len(old) - keep} 个，追加 {len(hashes) - keep} 个")
+    while len(old) > keep:
+        try:
+            notion.blocks.delete(block_id=old[-1][0])
+        except Exception as e:
+            if getattr(e, "status", None) != 404:
+                raise
+        old.pop()
+
+    def on_batch(batch, results):
+        start = len(old)
+        old.extend([result["id"], hashes[start + i]] for i, result in enumerate(results))
+
+    append_notion_blocks(entry["page_id"], blocks[keep:], on_batch)
+
+def save_to_notion(report):
+    """
+    将已解析的内容同步到 Notion，按 发布日期 幂等：
+    当天已有页面时更新属性并只替换变化的 block，否则创建新页面再分批追加正文
+    """
     print("📓 正在同步至 Notion...")
+    state = load_state("notion_pages.json", {})
+    pages = state.setdefault("pages", {})
     try:
         # 获取当前日期（北京时间）
         publish_date = datetime.now(TZ_CN).strftime('%Y-%m-%d')
         
-        body_blocks = split_content_to_blocks(content)
+        metadata = report.metadata
+        body_blocks = render_notion_blocks(report.blocks)
         
         # 构建 properties，包括发布日期
         properties = {
@@ -482,15 +2770,39 @@ def save_to_notion(metadata, content):
             "核心领域": {"multi_select": [{"name": tag} for tag in metadata.get('tags', []) if tag]},
             "发布日期": {"date": {"start": publish_date}}
         }
-        
-        notion.pages.create(
-            parent={"database_id": DATABASE_ID},
-            properties=properties,
-            children=body_blocks[:100] 
-        )
-        print(f"✅ Notion 同步成功！发布日期: {publish_date}")
+
+        entry = pages.get(publish_date)
+        if entry:
+            try:
+                notion.pages.update(page_id=entry["page_id"], properties=properties)
+            except Exception as e:
+                if getattr(e, "status", None) not in (400, 404):
+                    raise
+                print(f"⚠️ 缓存的 Notion 页面已不可用，重新查找: {e}")
+                entry = None
+        if not entry:
+            page_id = find_notion_page(state, publish_date)
+            if page_id:
+                print(f"📓 找到 {publish_date} 的已有页面，原地更新")
+                notion.pages.update(page_id=page_id, properties=properties)
+                # 已有 block 的内容未知，全部替换
+                entry = {"page_id": page_id, "blocks": [[block_id, None] for block_id in list_notion_children(page_id)]}
+            else:
+                page = notion.pages.create(parent={"database_id": DATABASE_ID}, properties=properties)
+                entry = {"page_id": page["id"], "blocks": []}
+        pages[publish_date] = entry
+
+        sync_notion_blocks(entry, body_blocks)
+        print(f"✅ Notion 同步成功！发布日期: {publish_date} | 共 {len(body_blocks)} 个 block")
     except Exception as e:
         print(f"❌ Notion 保存失败: {e}")
+    finally:
+        earliest = (datetime.now(TZ_CN) - timedelta(days=NOTION_PAGE_CACHE_DAYS)).strftime('%Y-%m-%d')
+        state["pages"] = {date: entry for date, entry in pages.items() if date >= earliest}
+        try:
+            save_state("notion_pages.json", state)
+        except OSError as e:
+            print(f"⚠️ 保存 Notion 页面映射失败: {e}")
 
 def update_archive_index(archive_dir):
     """遍历文件夹，生成归档列表"""
@@ -511,14 +2823,15 @@ def update_archive_index(archive_dir):
             f.write(f"- [{date_name} 的 AI 简报]({file})\n")
     print(f"✅ 归档索引已同步更新至: {index_path}")
 
-def update_homepage(metadata, content):
+def update_homepage(report):
     """动态更新首页 index.md，展示最新简报预览"""
     print("🏠 正在更新首页动态内容...")
     date_str = datetime.now(TZ_CN).strftime('%Y-%m-%d')
+    metadata = report.metadata
     
     # 1. 构造首页内容
-    # 我们只取正文的前 600 个字符作为预览，避免首页过长
-    preview_content = content[:600] + "..." if len(content) > 600 else content
+    # 我们只取正文开头约 600 个字符的完整段落作为预览，避免首页过长
+    preview_content = render_preview(report, 600)
     
     homepage_template = f"""# 🤖 AI 每日深度研究简报
 
@@ -550,9 +2863,10 @@ def update_homepage(metadata, content):
     print("✅ 首页已更新为最新内容")
 
 
-def save_to_markdown_file(metadata, content):
+def save_to_markdown_file(report):
     """将内容保存为 Markdown 文件，供 MkDocs 使用"""
     date_str = datetime.now(TZ_CN).strftime('%Y-%m-%d')
+    metadata = report.metadata
     print(f"🌐 正在生成网页文件: {date_str}.md")
     
     # 确保目录存在
@@ -572,7 +2886,7 @@ description: {metadata.get('summary')}
 
 > **摘要**: {metadata.get('summary')}
 
-{content}
+{report.content}
 
 <div class="subscribe-card">
     <div class="subscribe-title">📩 订阅每日 AI 简报</div>
@@ -590,7 +2904,7 @@ description: {metadata.get('summary')}
         f.write(full_markdown)
     print(f"✅ 网页文件已保存至: {file_path}")
 
-def publish_to_github_issue(metadata, content):
+def publish_to_github_issue(report):
     """将简报发布为您 GitHub 仓库的 Issue，实现邮件推送订阅"""
     if not GITHUB_TOKEN or not GITHUB_REPO:
         print("⚠️ 未配置 GITHUB_TOKEN 或 GITHUB_REPOSITORY，跳过 Issue 发布")
@@ -598,10 +2912,11 @@ def publish_to_github_issue(metadata, content):
 
     print("📧 正在发布 GitHub Issue...")
     try:
-        g = Github(GITHUB_TOKEN)
+        g = Github(GITHUB_TOKEN, base_url=GITHUB_API_URL) if GITHUB_API_URL else Github(GITHUB_TOKEN)
         repo = g.get_repo(GITHUB_REPO)
         
         # 构造 Issue 标题和正文
+        metadata = report.metadata
         date_str = datetime.now(TZ_CN).strftime('%Y-%m-%d')
         issue_title = f"{date_str} | {metadata.get('title')}"
         
@@ -613,7 +2928,7 @@ def publish_to_github_issue(metadata, content):
 
 ---
 
-{content}
+{report.content}
 
 ---
 *本报告由 AI Agent 自动生成，回复本 Issue 可参与讨论。*
@@ -623,6 +2938,30 @@ def publish_to_github_issue(metadata, content):
     except Exception as e:
         print(f"❌ GitHub Issue 发布失败: {e}")
 
+def publish_site(report):
+    """更新 MkDocs 站点: 当天详情页 → 归档索引 → 首页 (同一目录，按顺序执行)"""
+    # 存储当天详情页 (.md 文件)
+    save_to_markdown_file(report)
+    # 更新"索引目录" (让 Archives 页面出现新链接)
+    update_archive_index("docs/archives")
+    # 更新"网站首页" (让首页展示今天的预览)
+    update_homepage(report)
+
+def publish_report(report):
+    """
+    所有输出环节共用同一个 Report，彼此独立，并行执行
+    Notion / Issue / 邮件各自捕获异常；网页生成失败时在其余环节结束后抛出
+    """
+    sinks = [publish_site, publish_to_github_issue, send_email_newsletter]
+    # 同步 Notion (可选备份)
+    if NOTION_TOKEN and DATABASE_ID:
+        sinks.append(save_to_notion)
+
+    with ThreadPoolExecutor(max_workers=len(sinks)) as pool:
+        futures = [pool.submit(sink, report) for sink in sinks]
+    for future in futures:
+        future.result()
+
 if __name__ == "__main__":
     if not GEMINI_API_KEY:
         print("❌ 错误: GEMINI_API_KEY 未设置")
@@ -632,45 +2971,53 @@ if __name__ == "__main__":
     print("🤖 AI Daily News Brief - Deep Research Edition")
     print("="*70)
 
+    evict_llm_cache()
+    atexit.register(write_run_report)  # 失败退出时也保留已发生调用的统计
+
     # 1. 运行 Deep Research（带降级机制）
-    try:
-        raw_report = run_deep_research()
-        print("\n✅ Deep Research 执行成功")
-    except Exception as e:
-        print(f"\n⚠️ Deep Research 失败，使用降级方案: {e}")
+    if not deep_research_breaker_allows():
+        # 熔断中: 不再等待 Deep Research 失败，直接使用降级方案
         try:
-            raw_report = run_gemini3_research_fallback()
+            raw_report = run_fallback_research()
             print("\n✅ 降级方案执行成功")
-        except Exception as e2:
-            print(f"\n❌ 降级方案也失败了: {e2}")
+        except Exception as e:
+            print(f"\n❌ 降级方案失败: {e}")
             exit(1)
+    elif HEDGE_FALLBACK_DELAY:
+        # 对冲模式: 两条路径并行竞速，都失败才退出
+        try:
+            raw_report = run_hedged_research(float(HEDGE_FALLBACK_DELAY))
+            print("\n✅ 对冲研究执行成功")
+        except Exception as e:
+            print(f"\n❌ 对冲研究失败: {e}")
+            exit(1)
+    else:
+        try:
+            raw_report = run_deep_research()
+            print("\n✅ Deep Research 执行成功")
+        except Exception as e:
+            print(f"\n⚠️ Deep Research 失败，使用降级方案: {e}")
+            try:
+                raw_report = run_fallback_research()
+                print("\n✅ 降级方案执行成功")
+            except Exception as e2:
+                print(f"\n❌ 降级方案也失败了: {e2}")
+                exit(1)
     
-    # 2. 解析内容
-    meta, body = parse_gemini_response(raw_report)
-    if not meta:
+    # 2. 解析内容 (只解析一次，后续环节复用)
+    report = parse_report(raw_report)
+    if report is None:
         meta = {"title": f"AI 深度简报 - {datetime.now(TZ_CN).strftime('%Y-%m-%d')}", "summary": "今日情报已送达", "tags": ["AI"]}
+        report = Report(meta, raw_report, complete=False)
 
-    print(f"\n📋 报告标题: {meta.get('title')}")
-    print(f"📊 报告长度: {len(body)} 字符")
-
-    # 3. 存储当天详情页 (.md 文件)
-    save_to_markdown_file(meta, body) 
-
-    # 4. 更新"索引目录" (让 Archives 页面出现新链接)
-    update_archive_index("docs/archives") 
-
-    # 5. 更新"网站首页" (让首页展示今天的预览)
-    update_homepage(meta, body)
-
-    # 6. 同步 Notion (可选备份)
-    if NOTION_TOKEN and DATABASE_ID:
-        save_to_notion(meta, body)
+    # 过滤近期已报道过的情报
+    report = drop_covered_items(report)
 
-    # 7. 发布 GitHub Issue (作为邮件订阅渠道)
-    publish_to_github_issue(meta, body)
+    print(f"\n📋 报告标题: {report.metadata.get('title')}")
+    print(f"📊 报告长度: {len(report.content)} 字符")
 
-    # 8. SMTP 邮件推送
-    send_email_newsletter(meta, body)
+    # 3-8. 网页、Notion、GitHub Issue、邮件并行输出
+    publish_report(report)
 
     print("\n" + "="*70)
     print("🎉 所有任务完成！")
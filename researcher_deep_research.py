@@ -4,9 +4,11 @@ Deep Research 版本的 AI Daily News Brief 核心研究引擎
 """
 
 import os
+import ast
 import json
 import re
 import time
+import atexit
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import smtplib
@@ -17,6 +19,9 @@ from google import genai
 from google.genai import types
 from notion_client import Client
 from github import Github
+from researcher import generate_text  # 带磁盘缓存的 generate_content
+from researcher import STRUCTURED_OUTPUT, REPORT_SCHEMA, render_structured_report
+from researcher import DEEP_RESEARCH_AGENT, record_llm_call, write_run_report  # 调用统计与运行报告
 
 # 设置北京时区
 TZ_CN = ZoneInfo("Asia/Shanghai")
@@ -201,13 +206,15 @@ AI professionals, developers, researchers, and enthusiasts who need:
 Act as their personal AI intelligence officer. Spend the necessary time to thoroughly research, verify, and synthesize the most important AI developments of the day. Quality over speed.
     """
     
+    start_time = time.time()
+    interaction = None
+    poll_count = 0
+    recorded = False
     try:
-        start_time = time.time()
-        
         # 创建后台研究任务
         interaction = client.interactions.create(
             input=research_task,
-            agent='deep-research-pro-preview-12-2025',
+            agent=DEEP_RESEARCH_AGENT,
             background=True  # 异步执行，因为可能需要 5-20 分钟
         )
         
@@ -215,7 +222,6 @@ Act as their personal AI intelligence officer. Spend the necessary time to thoro
         print("📊 任务状态监控中...")
         
         # 轮询检查任务状态
-        poll_count = 0
         while True:
             poll_count += 1
             interaction = client.interactions.get(interaction.id)
@@ -225,6 +231,9 @@ Act as their personal AI intelligence officer. Spend the necessary time to thoro
             if status == "completed":
                 elapsed = time.time() - start_time
                 print(f"✅ 研究完成！耗时: {elapsed/60:.1f} 分钟")
+                record_llm_call("deep_research", DEEP_RESEARCH_AGENT, elapsed, getattr(interaction, "usage", None),
+                                prompt_chars=len(research_task), polls=poll_count)
+                recorded = True
                 
                 # 获取最终输出
                 if interaction.outputs and len(interaction.outputs) > 0:
@@ -252,6 +261,11 @@ Act as their personal AI intelligence officer. Spend the necessary time to thoro
                     
     except Exception as e:
         print(f"❌ Deep Research 执行失败: {e}")
+        # 创建失败、任务失败或超时也计入调用统计
+        if not recorded:
+            record_llm_call("deep_research", DEEP_RESEARCH_AGENT, time.time() - start_time,
+                            getattr(interaction, "usage", None),
+                            prompt_chars=len(research_task), polls=poll_count, error=type(e).__name__)
         raise
 
 
@@ -333,37 +347,120 @@ def run_gemini3_research_fallback():
     ---END_CONTENT---
     """
 
-    response = client.models.generate_content(
+    return generate_text(
         model='gemini-2.0-flash-exp',  # 使用更稳定的模型
         contents=prompt,
         config=types.GenerateContentConfig(
             tools=[types.Tool(google_search=types.GoogleSearch())],
-        )
+        ),
+        label="fallback"
     )
-    return response.text
 
 
-def parse_gemini_response(raw_text):
-    """从原始文本中提取元数据和正文内容"""
+def parse_gemini_response(raw_text, allow_ai_reformat=True):
+    """
+    从原始文本中提取元数据和正文内容
+    格式不符时先尝试本地修复，本地修复失败才调用 AI 重新格式化（仅一次）
+    """
     try:
         metadata_match = re.search(r'---START_METADATA---(.*?)---END_METADATA---', raw_text, re.DOTALL)
         content_match = re.search(r'---START_CONTENT---(.*?)---END_CONTENT---', raw_text, re.DOTALL)
         
         if metadata_match and content_match:
-            json_str = metadata_match.group(1).strip()
-            # 清理 JSON 中可能包裹的 markdown 代码块标识
-            json_str = re.sub(r'^```json|```$', '', json_str, flags=re.MULTILINE).strip()
-            metadata = json.loads(json_str)
+            metadata = lenient_json_loads(metadata_match.group(1))
             content = content_match.group(1).strip()
-            return metadata, content
-        else:
-            # 如果没有找到标记，尝试用 AI 重新格式化
-            print("⚠️ 未找到标准格式标记，尝试使用 AI 重新格式化...")
-            return reformat_with_ai(raw_text)
+            if metadata is not None:
+                return metadata, content
     except Exception as e:
         print(f"⚠️ 解析出错: {e}")
+
+    # 本地修复：毫秒级，覆盖绝大多数格式问题
+    repaired = repair_report_locally(raw_text)
+    if repaired:
+        print("🩹 报告格式已在本地修复")
+        return repaired
+
+    if not allow_ai_reformat:
         return None, raw_text
 
+    # 如果本地也无法修复，尝试用 AI 重新格式化
+    print("⚠️ 未找到标准格式标记且本地修复失败，尝试使用 AI 重新格式化...")
+    return reformat_with_ai(raw_text)
+
+
+def lenient_json_loads(text):
+    """
+    宽松解析元数据 JSON：依次处理代码块包裹、前后多余文字、智能引号、尾随逗号和单引号字典
+    全部失败时返回 None
+    """
+    json_str = re.sub(r'^\s*```(?:json)?|```\s*$', '', text.strip(), flags=re.MULTILINE).strip()
+    start, end = json_str.find("{"), json_str.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    json_str = json_str[start:end + 1]
+
+    candidates = [json_str]
+    # 只替换充当 JSON 分隔符的智能引号，正文里的中文引号保持不变
+    fixed = re.sub(r'([{\[,:]\s*)[“”]', r'\1"', json_str)
+    fixed = re.sub(r'[“”](\s*[:,}\]])', r'"\1', fixed)
+    fixed = re.sub(r',\s*([}\]])', r'\1', fixed)
+    candidates.append(fixed)
+
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            continue
+    try:
+        data = ast.literal_eval(fixed)
+        return data if isinstance(data, dict) else None
+    except Exception:
+        # literal_eval 对畸形输入还会抛 TypeError / RecursionError / MemoryError，一律交给后续修复流程
+        return None
+
+
+def repair_report_locally(raw_text):
+    """
+    确定性的本地修复，返回 (metadata, content)，无法修复时返回 None
+    - 缺少 CONTENT 标记时，以 "# 💡 首席洞察" 标题作为正文起点
+    - 元数据取自 METADATA 块或正文之前的 JSON（宽松解析），都没有时由第一条 "###" 情报合成
+    """
+    content_match = re.search(r'---START_CONTENT---(.*?)(?:---END_CONTENT---|\Z)', raw_text, re.DOTALL)
+    if content_match:
+        content, preamble = content_match.group(1), raw_text[:content_match.start()]
+    else:
+        heading = re.search(r'^\s*#\s*💡\s*首席洞察.*$', raw_text, re.MULTILINE)
+        if not heading:
+            return None
+        content, preamble = raw_text[heading.start():], raw_text[:heading.start()]
+    content = re.sub(r'---(START|END)_(METADATA|CONTENT)---', '', content).strip()
+    if not content:
+        return None
+
+    metadata_match = re.search(r'---START_METADATA---(.*?)(?:---END_METADATA---|\Z)', preamble, re.DOTALL)
+    metadata = lenient_json_loads(metadata_match.group(1) if metadata_match else preamble)
+    if metadata is None or not metadata.get("title"):
+        metadata = synthesize_metadata(content)
+    return metadata, content
+
+
+def synthesize_metadata(content):
+    """由正文合成元数据：标题取第一条 "###" 情报，摘要取首席洞察的开头"""
+    first_item = re.search(r'^###\s*(?:\d+\.\s*)?(.+)$', content, re.MULTILINE)
+    title = first_item.group(1).strip() if first_item else f"AI 深度简报 - {datetime.now(TZ_CN).strftime('%Y-%m-%d')}"
+
+    insight = re.search(r'首席洞察.*?\n+(.+?)(?:\n\s*\n|\n#)', content, re.DOTALL)
+    summary = re.sub(r'[*#>\s]+', ' ', insight.group(1)).strip() if insight else "今日 AI 行业情报已送达"
+
+    return {
+        "title": title[:30],
+        "summary": summary[:100],
+        "tags": ["AI", "深度研究"],
+        "importance": 7
+    }
+
 
 def reformat_with_ai(raw_report):
     """
@@ -417,14 +514,40 @@ def reformat_with_ai(raw_report):
 {raw_report}
 """
     
+    if STRUCTURED_OUTPUT:
+        # 结构化模式：按 JSON Schema 提取，再在本地渲染为标准格式
+        conversion_prompt = f"""
+你是一个内容格式化专家。请从以下 AI 研究报告中提取所有关键信息，按给定的 JSON Schema 输出。
+
+要求：
+1. 保留所有来源 URL 和时间
+2. 使用简体中文
+3. 不要输出任何 JSON 以外的内容
+
+原始报告：
+{raw_report}
+"""
+
     try:
-        response = client.models.generate_content(
+        formatted_text = generate_text(
             model='gemini-2.0-flash-exp',
-            contents=conversion_prompt
+            contents=conversion_prompt,
+            config=types.GenerateContentConfig(
+                response_mime_type="application/json",
+                response_schema=REPORT_SCHEMA
+            ) if STRUCTURED_OUTPUT else None,
+            label="reformat"
         )
-        
-        formatted_text = response.text
-        return parse_gemini_response(formatted_text)
+        if STRUCTURED_OUTPUT:
+            formatted_text = render_structured_report(formatted_text)
+            if formatted_text is None:
+                # 结构化输出不可用，保留原始报告
+                return None, raw_report
+        metadata, content = parse_gemini_response(formatted_text, allow_ai_reformat=False)
+        if metadata is None:
+            # 重新格式化后仍不合格，保留原始报告而不是格式化失败的输出
+            return None, raw_report
+        return metadata, content
         
     except Exception as e:
         print(f"❌ AI 重新格式化失败: {e}")
@@ -453,6 +576,7 @@ if __name__ == "__main__":
     print("="*60)
     print("🤖 AI Daily News Brief - Deep Research Edition")
     print("="*60)
+    atexit.register(write_run_report)  # 失败退出时也保留已发生调用的统计
     
     # 1. 运行 Deep Research（带降级机制）
     try: